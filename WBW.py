@@ -2,35 +2,37 @@
 import pandas as pd
 import numpy as np
 from datetime import datetime
-import os
 import sys
+import heapq
 import traceback
 import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import WBW2
+from instrumentation import collected_records, collecting_logger, current_logger, log_text, logging_to, recording, replay_records, run_logger, stage
+from report_writer import OutputBundle, as_output, open_report, write_csv
+from tax_lots import TaxLotStore
+
+logger = logging.getLogger(__name__)
+
+# 8-decimal precision for DataFrames in the log
+FLOAT_FORMAT = '{:.8f}'.format
 
-# Set up logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
-logging.info("Script started - logging initialized.")
 
-# Set pandas options for 8-decimal precision
-pd.set_option('display.float_format', '{:.8f}'.format)
-logging.info("Set pandas display options.")
+def _log():
+    # Each run logs to its own logger (see ReconciliationEngine)
+    return current_logger(logger)
 
 def load_data(closing_file_path_or_object, balance_file_path_or_object):
-    logging.info("Loading closing position report.")
-    logging.info("Loading balance by exchange report.")
+    _log().info("Loading closing position report.")
+    _log().info("Loading balance by exchange report.")
     
     try:
         raw_closing_df = pd.read_csv(closing_file_path_or_object)
         raw_balance_df = pd.read_csv(balance_file_path_or_object)
-        logging.info("Successfully loaded both CSV files.")
+        _log().info("Successfully loaded both CSV files.")
     except Exception as e:
-        logging.error(f"Error loading CSV files: {str(e)}")
+        _log().error(f"Error loading CSV files: {str(e)}")
         raise
     
     closing_df = raw_closing_df.copy()
@@ -67,13 +69,13 @@ def load_data(closing_file_path_or_object, balance_file_path_or_object):
     closing_df['Calculated Cost Basis'] = closing_df['Amount'] * closing_df['Purchase Price in USD']
     inconsistencies = closing_df[abs(closing_df['Cost Basis in USD'] - closing_df['Calculated Cost Basis']) > 1e-8]
     if not inconsistencies.empty:
-        logging.warning("Data inconsistencies found in closing_df:")
-        logging.warning(inconsistencies[['Amount', 'Purchase Price in USD', 'Cost Basis in USD', 'Calculated Cost Basis']])
+        _log().warning("Data inconsistencies found in closing_df:")
+        _log().warning(inconsistencies[['Amount', 'Purchase Price in USD', 'Cost Basis in USD', 'Calculated Cost Basis']])
     
     return raw_closing_df, raw_balance_df, closing_df, balance_df
 
 def calculate_discrepancies(closing_df, balance_df):
-    logging.info("Calculating initial discrepancies.")
+    _log().info("Calculating initial discrepancies.")
     
     closing_agg = closing_df.groupby(['Currency', 'Account'])['Amount'].sum().reset_index()
     balance_agg = balance_df.groupby(['Currency', 'Account'])['Amount'].sum().reset_index()
@@ -97,18 +99,139 @@ def calculate_discrepancies(closing_df, balance_df):
     ).fillna(0)
     global_discrepancies['Discrepancy'] = global_discrepancies['Amount_balance'] - global_discrepancies['Amount_closing']
     
-    logging.info("Discrepancy calculation completed.")
+    _log().info("Discrepancy calculation completed.")
     return discrepancies_simple, global_discrepancies
 
-def reallocate_excess(closing_df, discrepancies, balance_df):
-    logging.info("Starting reallocation process.")
-    adjusted_df = closing_df.copy()
+class TaxLotPool:
+    """
+    Heap of one currency's excess lots in the order a shortage rule takes them.
+
+    Lots are ordered by purchase price (highest first for the CEX rule, lowest first
+    for the Wallet rule), then date acquired (oldest first for CEX, newest first for
+    Wallet, missing dates last), then largest amount, then lot order. Exhausted
+    lots and lots whose source account has reached its excess limit are dropped
+    lazily when they reach the top, and partly used lots are re-queued with their
+    new amount, so each allocation costs O(log n) instead of a full sort and scan.
+    """
+
+    def __init__(self, store, lots, highest_price_first, excess_limits, reallocated_amounts):
+        self.store = store
+        self.excess_limits = excess_limits
+        self.reallocated_amounts = reallocated_amounts
+
+        prices = store.purchase_price[lots]
+        dates = np.asarray(store.date[lots], dtype='datetime64[ns]')
+        missing_price, missing_date = np.isnan(prices), np.isnat(dates)
+        price_keys = np.where(missing_price, 0.0, -prices if highest_price_first else prices)
+        date_keys = np.where(missing_date, 0, dates.astype('int64'))
+        date_keys = date_keys if highest_price_first else -date_keys
+        amounts = store.amount[lots]
+        self.heap = list(zip(missing_price.tolist(), price_keys.tolist(), missing_date.tolist(), date_keys.tolist(),
+                             (-amounts).tolist(), lots.tolist()))
+        heapq.heapify(self.heap)
+
+    def source_limit(self, source_account):
+        """How much more can be taken from `source_account`, or None once it has reached its excess limit."""
+        if source_account not in self.excess_limits or self.reallocated_amounts[source_account] >= -self.excess_limits[source_account]:
+            return None
+        max_reallocatable = -self.excess_limits[source_account] - self.reallocated_amounts[source_account]
+        return max_reallocatable if max_reallocatable > 1e-8 else None
+
+    def peek(self):
+        """Id of the next lot to take from, or None once no lot can be used."""
+        amounts = self.store.amount
+        while self.heap:
+            entry = self.heap[0]
+            lot = entry[-1]
+            if amounts[lot] <= 1e-8 or self.source_limit(self.store.account_of(lot)) is None:
+                heapq.heappop(self.heap)
+            elif -entry[4] != amounts[lot]:
+                heapq.heapreplace(self.heap, entry[:4] + (-amounts[lot], lot))
+            else:
+                return lot
+        return None
+
+def reallocate_to_shortages(store, pool, shortages, currency, rule, reallocation_details):
+    for _, shortage in shortages.iterrows():
+        target_account = shortage['Account']
+        shortage_amount = shortage['Discrepancy']
+        if shortage_amount <= 1e-8:
+            continue
+        _log().info("Reallocating %.8f %s to %s %s", shortage_amount, currency, rule, target_account)
+        
+        remaining = shortage_amount
+        while remaining > 1e-8:
+            lot = pool.peek()
+            if lot is None:
+                break
+            source_account = store.account_of(lot)
+            available = store.amount[lot]
+            amount_to_reallocate = min(available, remaining, pool.source_limit(source_account))
+            purchase_price = store.purchase_price[lot]
+            cost_basis = store.cost_basis[lot]
+            
+            if purchase_price == 0 and cost_basis != 0:
+                proportion = amount_to_reallocate / available
+                cost_basis_to_transfer = cost_basis * proportion
+            else:
+                cost_basis_to_transfer = amount_to_reallocate * purchase_price
+            year_end_value = amount_to_reallocate * store.year_end_price[lot]
+            new_lot = store.transfer(lot, amount_to_reallocate, target_account, cost_basis_to_transfer, year_end_value)
+            
+            total_cost_basis_transferred = cost_basis_to_transfer
+            exhausted, leftover = store.close_exhausted(lot)
+            if leftover[0] > 0:
+                # A used-up lot's remaining cost basis moves with it
+                store.cost_basis[new_lot] += leftover[0]
+                store.gain_loss[new_lot] = store.year_end_value[new_lot] - store.cost_basis[new_lot]
+                total_cost_basis_transferred += leftover[0]
+            if exhausted[0]:
+                store.comment(lot, f"Exhausted {amount_to_reallocate:.8f} {currency}; originally held {available:.8f} {currency}; reallocated to {target_account} ({rule} rule)")
+            else:
+                store.comment(lot, f"Partially used {amount_to_reallocate:.8f} {currency} reallocated to {target_account} ({rule} rule)")
+            new_lot_comment = f"Reallocated {amount_to_reallocate:.8f} {currency} from {source_account} to {target_account} ({rule} rule)"
+            store.comment(new_lot, new_lot_comment)
+            
+            reallocation_details.append({
+                'Currency': currency,
+                'Source Account': source_account,
+                'Target Account': target_account,
+                'Amount': amount_to_reallocate,
+                'Cost Basis Transferred in USD': total_cost_basis_transferred,
+                'Purchase Price in USD': purchase_price,
+                'Date Acquired': pd.Timestamp(store.date[lot]),
+                'Reason': f'Reallocation to {rule} shortage',
+                'Comment': new_lot_comment
+            })
+            remaining -= amount_to_reallocate
+            pool.reallocated_amounts[source_account] += amount_to_reallocate
+
+def _warn_inconsistencies(store, frame_name):
+    calculated_cost_basis = store.amount * store.purchase_price
+    inconsistent = abs(store.cost_basis - calculated_cost_basis) > 1e-8
+    if inconsistent.any():
+        _log().warning(f"Data inconsistencies found in {frame_name}:")
+        _log().warning(pd.DataFrame({
+            'Amount': store.amount[inconsistent],
+            'Purchase Price in USD': store.purchase_price[inconsistent],
+            'Cost Basis in USD': store.cost_basis[inconsistent],
+            'Calculated Cost Basis': calculated_cost_basis[inconsistent],
+        }, index=np.flatnonzero(inconsistent)))
+
+def lots_frame(store):
+    """The store's lots as a closing position frame, with 'Calculated Cost Basis' brought up to date."""
+    lots_df = store.to_frame()
+    lots_df['Calculated Cost Basis'] = lots_df['Amount'] * lots_df['Purchase Price in USD']
+    return lots_df
+
+def reallocate_lots(store, discrepancies, balance_df):
+    """Moves excess lots to CEX and Wallet shortage accounts within the store. Returns the reallocation details."""
+    _log().info("Starting reallocation process.")
     reallocation_details = []
     
     for currency in discrepancies['Currency'].unique():
         curr_discrepancies = discrepancies[discrepancies['Currency'] == currency]
         excess_accounts = curr_discrepancies[curr_discrepancies['Discrepancy'] < -1e-8]['Account'].unique()
-        shortage_accounts = curr_discrepancies[curr_discrepancies['Discrepancy'] > 1e-8]['Account'].unique()
         
         cex_shortages = curr_discrepancies[
             (curr_discrepancies['Discrepancy'] > 1e-8) & 
@@ -119,209 +242,97 @@ def reallocate_excess(closing_df, discrepancies, balance_df):
             (curr_discrepancies['Account'].isin(balance_df[balance_df['Account Type'] == 'Wallet']['Account']))
         ].sort_values('Account')
         
-        excess_tax_lots = adjusted_df[
-            (adjusted_df['Currency'] == currency) & 
-            (adjusted_df['Account'].isin(excess_accounts)) & 
-            (adjusted_df['Amount'] > 0)
-        ].copy()
+        excess_lots = store.lots(currency, excess_accounts)
         
         excess_limits = curr_discrepancies[curr_discrepancies['Discrepancy'] < -1e-8].set_index('Account')['Discrepancy'].to_dict()
         reallocated_amounts = {account: 0.0 for account in excess_accounts}
         
-        for _, shortage in cex_shortages.iterrows():
-            target_account = shortage['Account']
-            shortage_amount = shortage['Discrepancy']
-            if shortage_amount <= 1e-8:
-                continue
-            logging.info(f"Reallocating {shortage_amount:.8f} {currency} to CEX {target_account}")
-            
-            available_tax_lots = excess_tax_lots.sort_values(
-                by=['Purchase Price in USD', 'Date Acquired', 'Amount'],
-                ascending=[False, True, False]
-            )
-            remaining = shortage_amount
-            for idx, tax_lot in available_tax_lots.iterrows():
-                if remaining <= 1e-8:
-                    break
-                source_account = tax_lot['Account']
-                if source_account not in excess_limits or reallocated_amounts[source_account] >= -excess_limits[source_account]:
-                    continue
-                available = tax_lot['Amount']
-                max_reallocatable = -excess_limits[source_account] - reallocated_amounts[source_account]
-                amount_to_reallocate = min(available, remaining, max_reallocatable)
-                
-                if amount_to_reallocate <= 1e-8:
-                    continue
-                
-                new_tax_lot = tax_lot.copy()
-                new_tax_lot['Account'] = target_account
-                new_tax_lot['Amount'] = amount_to_reallocate
-                new_tax_lot['Date Acquired'] = tax_lot['Date Acquired']
-                
-                if tax_lot['Purchase Price in USD'] == 0 and tax_lot['Cost Basis in USD'] != 0:
-                    proportion = amount_to_reallocate / tax_lot['Amount']
-                    cost_basis_to_transfer = tax_lot['Cost Basis in USD'] * proportion
-                else:
-                    cost_basis_to_transfer = amount_to_reallocate * tax_lot['Purchase Price in USD']
-                new_tax_lot['Cost Basis in USD'] = cost_basis_to_transfer
-                new_tax_lot['Year End Value in USD'] = amount_to_reallocate * tax_lot['Year End Price in USD']
-                new_tax_lot['Gain/Loss in USD'] = new_tax_lot['Year End Value in USD'] - new_tax_lot['Cost Basis in USD']
-                new_tax_lot['comments'] = f"Reallocated {amount_to_reallocate:.8f} {currency} from {source_account} to {target_account} (CEX rule)"
-                
-                adjusted_df.loc[idx, 'Amount'] -= amount_to_reallocate
-                adjusted_df.loc[idx, 'Cost Basis in USD'] -= cost_basis_to_transfer
-                adjusted_df.loc[idx, 'Year End Value in USD'] -= new_tax_lot['Year End Value in USD']
-                adjusted_df.loc[idx, 'Gain/Loss in USD'] -= new_tax_lot['Gain/Loss in USD']
-                total_cost_basis_transferred = cost_basis_to_transfer
-                if adjusted_df.loc[idx, 'Amount'] <= 1e-8:
-                    adjusted_df.loc[idx, 'Amount'] = 0
-                    remaining_cost_basis = adjusted_df.loc[idx, 'Cost Basis in USD']
-                    if remaining_cost_basis > 1e-8:
-                        new_tax_lot['Cost Basis in USD'] += remaining_cost_basis
-                        total_cost_basis_transferred += remaining_cost_basis
-                        new_tax_lot['Gain/Loss in USD'] = new_tax_lot['Year End Value in USD'] - new_tax_lot['Cost Basis in USD']
-                        adjusted_df.loc[idx, 'Cost Basis in USD'] = 0
-                        adjusted_df.loc[idx, 'Gain/Loss in USD'] = 0
-                    adjusted_df.loc[idx, 'comments'] = f"Exhausted {amount_to_reallocate:.8f} {currency}; originally held {tax_lot['Amount']:.8f} {currency}; reallocated to {target_account} (CEX rule)"
-                else:
-                    adjusted_df.loc[idx, 'comments'] = f"Partially used {amount_to_reallocate:.8f} {currency} reallocated to {target_account} (CEX rule)"
-                
-                adjusted_df = pd.concat([adjusted_df, pd.DataFrame([new_tax_lot])], ignore_index=True)
-                reallocation_details.append({
-                    'Currency': currency,
-                    'Source Account': source_account,
-                    'Target Account': target_account,
-                    'Amount': amount_to_reallocate,
-                    'Cost Basis Transferred in USD': total_cost_basis_transferred,
-                    'Purchase Price in USD': tax_lot['Purchase Price in USD'],
-                    'Date Acquired': tax_lot['Date Acquired'],
-                    'Reason': 'Reallocation to CEX shortage',
-                    'Comment': new_tax_lot['comments']
-                })
-                remaining -= amount_to_reallocate
-                reallocated_amounts[source_account] += amount_to_reallocate
-                excess_tax_lots.loc[idx, 'Amount'] -= amount_to_reallocate
-        
-        for _, shortage in wallet_shortages.iterrows():
-            target_account = shortage['Account']
-            shortage_amount = shortage['Discrepancy']
-            if shortage_amount <= 1e-8:
-                continue
-            logging.info(f"Reallocating {shortage_amount:.8f} {currency} to Wallet {target_account}")
-            
-            available_tax_lots = excess_tax_lots.sort_values(
-                by=['Purchase Price in USD', 'Date Acquired', 'Amount'],
-                ascending=[True, False, False]
-            )
-            remaining = shortage_amount
-            for idx, tax_lot in available_tax_lots.iterrows():
-                if remaining <= 1e-8:
-                    break
-                source_account = tax_lot['Account']
-                if source_account not in excess_limits or reallocated_amounts[source_account] >= -excess_limits[source_account]:
-                    continue
-                available = tax_lot['Amount']
-                max_reallocatable = -excess_limits[source_account] - reallocated_amounts[source_account]
-                amount_to_reallocate = min(available, remaining, max_reallocatable)
-                
-                if amount_to_reallocate <= 1e-8:
-                    continue
-                
-                new_tax_lot = tax_lot.copy()
-                new_tax_lot['Account'] = target_account
-                new_tax_lot['Amount'] = amount_to_reallocate
-                new_tax_lot['Date Acquired'] = tax_lot['Date Acquired']
-                
-                if tax_lot['Purchase Price in USD'] == 0 and tax_lot['Cost Basis in USD'] != 0:
-                    proportion = amount_to_reallocate / tax_lot['Amount']
-                    cost_basis_to_transfer = tax_lot['Cost Basis in USD'] * proportion
-                else:
-                    cost_basis_to_transfer = amount_to_reallocate * tax_lot['Purchase Price in USD']
-                new_tax_lot['Cost Basis in USD'] = cost_basis_to_transfer
-                new_tax_lot['Year End Value in USD'] = amount_to_reallocate * tax_lot['Year End Price in USD']
-                new_tax_lot['Gain/Loss in USD'] = new_tax_lot['Year End Value in USD'] - new_tax_lot['Cost Basis in USD']
-                new_tax_lot['comments'] = f"Reallocated {amount_to_reallocate:.8f} {currency} from {source_account} to {target_account} (Wallet rule)"
-                
-                adjusted_df.loc[idx, 'Amount'] -= amount_to_reallocate
-                adjusted_df.loc[idx, 'Cost Basis in USD'] -= cost_basis_to_transfer
-                adjusted_df.loc[idx, 'Year End Value in USD'] -= new_tax_lot['Year End Value in USD']
-                adjusted_df.loc[idx, 'Gain/Loss in USD'] -= new_tax_lot['Gain/Loss in USD']
-                total_cost_basis_transferred = cost_basis_to_transfer
-                if adjusted_df.loc[idx, 'Amount'] <= 1e-8:
-                    adjusted_df.loc[idx, 'Amount'] = 0
-                    remaining_cost_basis = adjusted_df.loc[idx, 'Cost Basis in USD']
-                    if remaining_cost_basis > 1e-8:
-                        new_tax_lot['Cost Basis in USD'] += remaining_cost_basis
-                        total_cost_basis_transferred += remaining_cost_basis
-                        new_tax_lot['Gain/Loss in USD'] = new_tax_lot['Year End Value in USD'] - new_tax_lot['Cost Basis in USD']
-                        adjusted_df.loc[idx, 'Cost Basis in USD'] = 0
-                        adjusted_df.loc[idx, 'Gain/Loss in USD'] = 0
-                    adjusted_df.loc[idx, 'comments'] = f"Exhausted {amount_to_reallocate:.8f} {currency}; originally held {tax_lot['Amount']:.8f} {currency}; reallocated to {target_account} (Wallet rule)"
-                else:
-                    adjusted_df.loc[idx, 'comments'] = f"Partially used {amount_to_reallocate:.8f} {currency} reallocated to {target_account} (Wallet rule)"
-                
-                adjusted_df = pd.concat([adjusted_df, pd.DataFrame([new_tax_lot])], ignore_index=True)
-                reallocation_details.append({
-                    'Currency': currency,
-                    'Source Account': source_account,
-                    'Target Account': target_account,
-                    'Amount': amount_to_reallocate,
-                    'Cost Basis Transferred in USD': total_cost_basis_transferred,
-                    'Purchase Price in USD': tax_lot['Purchase Price in USD'],
-                    'Date Acquired': tax_lot['Date Acquired'],
-                    'Reason': 'Reallocation to Wallet shortage',
-                    'Comment': new_tax_lot['comments']
-                })
-                remaining -= amount_to_reallocate
-                reallocated_amounts[source_account] += amount_to_reallocate
-                excess_tax_lots.loc[idx, 'Amount'] -= amount_to_reallocate
-    
-    adjusted_df['Calculated Cost Basis'] = adjusted_df['Amount'] * adjusted_df['Purchase Price in USD']
-    inconsistencies = adjusted_df[abs(adjusted_df['Cost Basis in USD'] - adjusted_df['Calculated Cost Basis']) > 1e-8]
-    if not inconsistencies.empty:
-        logging.warning("Data inconsistencies found in adjusted_df after reallocation:")
-        logging.warning(inconsistencies[['Amount', 'Purchase Price in USD', 'Cost Basis in USD', 'Calculated Cost Basis']])
+        # CEX shortages take the highest-priced, oldest lots first; wallets the cheapest, newest
+        cex_pool = TaxLotPool(store, excess_lots, True, excess_limits, reallocated_amounts)
+        reallocate_to_shortages(store, cex_pool, cex_shortages, currency, 'CEX', reallocation_details)
+        wallet_pool = TaxLotPool(store, excess_lots, False, excess_limits, reallocated_amounts)
+        reallocate_to_shortages(store, wallet_pool, wallet_shortages, currency, 'Wallet', reallocation_details)
     
-    logging.info("Reallocation process completed.")
-    return adjusted_df, pd.DataFrame(reallocation_details)
+    _warn_inconsistencies(store, "adjusted_df after reallocation")
+    _log().info("Reallocation process completed.")
+    return pd.DataFrame(reallocation_details)
 
-def resolve_global_adjustments(adjusted_df, global_discrepancies, balance_df):
-    logging.info("Resolving global adjustments.")
-    final_df = adjusted_df.copy()
+def reallocate_excess(closing_df, discrepancies, balance_df):
+    store = TaxLotStore.from_frame(closing_df)
+    reallocation_details = reallocate_lots(store, discrepancies, balance_df)
+    return lots_frame(store), reallocation_details
+
+def allocate_write_off(amounts, amount_to_write_off):
+    """
+    Splits a write-off over lots taken in order, as much of each lot as is still needed.
+
+    The cut lot is found with a cumulative sum and searchsorted instead of a loop;
+    lots after it (and any reached with 1e-8 or less still to go) get 0.
+    """
+    taken_before = np.concatenate(([0.0], np.cumsum(amounts)))[:len(amounts)]
+    n_used = np.searchsorted(taken_before, amount_to_write_off - 1e-8, side='left')
+    write_off_amounts = np.zeros(len(amounts))
+    write_off_amounts[:n_used] = np.minimum(amounts[:n_used], amount_to_write_off - taken_before[:n_used])
+    return write_off_amounts
+
+def resolve_global_lots(store, global_discrepancies, balance_df):
+    """
+    Adds zero-basis lots for global shortages and writes off lots for global excesses within the store.
+
+    Returns:
+        The write-off details and the manual entries added.
+    """
+    _log().info("Resolving global adjustments.")
     write_off_details = []
     manual_entries = []
     
-    closing_agg = final_df.groupby(['Currency', 'Account'])['Amount'].sum().reset_index()
+    closing_agg = pd.DataFrame({
+        'Currency': store.currencies.decode(store.currency),
+        'Account': store.accounts.decode(store.account),
+        'Amount': store.amount,
+    }).groupby(['Currency', 'Account'])['Amount'].sum().reset_index()
     balance_agg = balance_df.groupby(['Currency', 'Account'])['Amount'].sum().reset_index()
     
+    # Built once, keyed by (Currency, Account) and kept current as entries land,
+    # so each currency's pass is a keyed lookup instead of a fresh merge
     account_discrepancies = balance_agg.merge(
         closing_agg,
         on=['Currency', 'Account'],
         how='outer',
         suffixes=('_balance', '_closing')
-    ).fillna(0)
-    account_discrepancies['Discrepancy'] = account_discrepancies['Amount_balance'] - account_discrepancies['Amount_closing']
-    balanced_accounts = account_discrepancies[abs(account_discrepancies['Discrepancy']) <= 1e-8][['Currency', 'Account']]
+    ).fillna(0).set_index(['Currency', 'Account']).sort_index()
+    account_keys = account_discrepancies.index
+    amount_balance = account_discrepancies['Amount_balance'].to_numpy(dtype=float, copy=True)
+    amount_closing = account_discrepancies['Amount_closing'].to_numpy(dtype=float, copy=True)
+    discrepancy = amount_balance - amount_closing
+    balanced = abs(discrepancy) <= 1e-8
+    
+    def currency_discrepancies(currency):
+        rows = account_keys.get_locs([currency]) if currency in account_keys.levels[0] else slice(0, 0)
+        return pd.DataFrame({
+            'Currency': account_keys.get_level_values('Currency')[rows],
+            'Account': account_keys.get_level_values('Account')[rows],
+            'Amount_balance': amount_balance[rows],
+            'Amount_closing': amount_closing[rows],
+            'Discrepancy': discrepancy[rows],
+            'Balanced': balanced[rows],
+        })
+    
+    def record(currency, account, closing_change):
+        pos = account_keys.get_loc((currency, account))
+        amount_closing[pos] += closing_change
+        discrepancy[pos] -= closing_change
     
     for _, global_row in global_discrepancies.iterrows():
         currency = global_row['Currency']
         global_discrepancy = global_row['Discrepancy']
-        logging.info(f"Processing global discrepancy for {currency}: {global_discrepancy:.8f}")
+        _log().info("Processing global discrepancy for %s: %.8f", currency, global_discrepancy)
         
         if global_discrepancy > 1e-8:
-            account_discrepancies = balance_agg.merge(
-                closing_agg,
-                on=['Currency', 'Account'],
-                how='outer',
-                suffixes=('_balance', '_closing')
-            ).fillna(0)
-            account_discrepancies['Discrepancy'] = account_discrepancies['Amount_balance'] - account_discrepancies['Amount_closing']
-            shortage_accounts = account_discrepancies[
-                (account_discrepancies['Currency'] == currency) & 
-                (account_discrepancies['Discrepancy'] > 1e-8) &
-                (~account_discrepancies[['Currency', 'Account']].apply(tuple, axis=1).isin(
-                    balanced_accounts[['Currency', 'Account']].apply(tuple, axis=1)
-                ))
+            curr_discrepancies = currency_discrepancies(currency)
+            shortage_accounts = curr_discrepancies[
+                (curr_discrepancies['Discrepancy'] > 1e-8) &
+                (~curr_discrepancies['Balanced'])
             ].sort_values('Account')
             
             if not shortage_accounts.empty:
@@ -333,9 +344,10 @@ def resolve_global_adjustments(adjusted_df, global_discrepancies, balance_df):
                     amount_to_add = min(account_shortage, global_discrepancy * proportion)
                     if amount_to_add <= 1e-8:
                         continue
-                    logging.info(f"Adding manual entry of {amount_to_add:.8f} {currency} to {account}")
+                    _log().info("Adding manual entry of %.8f %s to %s", amount_to_add, currency, account)
                     
-                    year_end_price = final_df[final_df['Currency'] == currency]['Year End Price in USD'].iloc[0] if not final_df[final_df['Currency'] == currency].empty else 0
+                    currency_lots = store.lots(currency, positive=False)
+                    year_end_price = store.year_end_price[currency_lots[0]] if len(currency_lots) else 0
                     account_type = balance_df[balance_df['Account'] == account]['Account Type'].iloc[0] if not balance_df[balance_df['Account'] == account].empty else 'Unknown'
                     
                     manual_entry = {
@@ -351,22 +363,13 @@ def resolve_global_adjustments(adjusted_df, global_discrepancies, balance_df):
                         'Gain/Loss in USD': amount_to_add * year_end_price,
                         'comments': f"Manual zero-basis entry of {amount_to_add:.8f} {currency} added to resolve global shortage"
                     }
-                    final_df = pd.concat([final_df, pd.DataFrame([manual_entry])], ignore_index=True)
+                    store.add(manual_entry)
                     manual_entries.append(manual_entry)
+                    record(currency, account, amount_to_add)
         
         elif global_discrepancy < -1e-8:
-            account_discrepancies = balance_agg.merge(
-                closing_agg,
-                on=['Currency', 'Account'],
-                how='outer',
-                suffixes=('_balance', '_closing')
-            ).fillna(0)
-            account_discrepancies['Discrepancy'] = account_discrepancies['Amount_balance'] - account_discrepancies['Amount_closing']
-            excess_accounts = account_discrepancies
-            excess_accounts = excess_accounts[
-                (excess_accounts['Currency'] == currency) & 
-                (excess_accounts['Discrepancy'] < -1e-8)
-            ].sort_values('Account')
+            curr_discrepancies = currency_discrepancies(currency)
+            excess_accounts = curr_discrepancies[curr_discrepancies['Discrepancy'] < -1e-8].sort_values('Account')
             
             if not excess_accounts.empty:
                 total_excess = -excess_accounts['Discrepancy'].sum()
@@ -377,80 +380,165 @@ def resolve_global_adjustments(adjusted_df, global_discrepancies, balance_df):
                     amount_to_write_off = min(account_excess, -global_discrepancy * proportion)
                     if amount_to_write_off <= 1e-8:
                         continue
-                    logging.info(f"Writing off {amount_to_write_off:.8f} {currency} from {account}")
+                    _log().info("Writing off %.8f %s from %s", amount_to_write_off, currency, account)
+                    
+                    account_lots = store.lots(currency, [account])
+                    tax_lots = pd.DataFrame({
+                        'Purchase Price in USD': store.purchase_price[account_lots],
+                        'Date Acquired': store.date[account_lots],
+                        'Amount': store.amount[account_lots],
+                    }, index=account_lots).sort_values(['Purchase Price in USD', 'Date Acquired', 'Amount'], ascending=[True, False, False])
                     
-                    tax_lots = final_df[
-                        (final_df['Currency'] == currency) & 
-                        (final_df['Account'] == account) & 
-                        (final_df['Amount'] > 0)
-                    ].sort_values(['Purchase Price in USD', 'Date Acquired', 'Amount'], ascending=[True, False, False])
+                    amounts = tax_lots['Amount'].to_numpy(dtype=float)
+                    write_off_amounts = allocate_write_off(amounts, amount_to_write_off)
+                    used = write_off_amounts > 0
+                    lots, amounts, write_off_amounts = tax_lots.index.to_numpy()[used], amounts[used], write_off_amounts[used]
+                    purchase_prices = store.purchase_price[lots]
+                    cost_bases = store.cost_basis[lots]
                     
-                    remaining = amount_to_write_off
-                    for idx, tax_lot in tax_lots.iterrows():
-                        if remaining <= 1e-8:
-                            break
-                        write_off_amount = min(tax_lot['Amount'], remaining)
-                        cost_basis_to_write_off = 0.0
-                        if tax_lot['Purchase Price in USD'] == 0 and tax_lot['Cost Basis in USD'] != 0:
-                            proportion = write_off_amount / tax_lot['Amount']
-                            cost_basis_to_write_off = tax_lot['Cost Basis in USD'] * proportion
-                        else:
-                            cost_basis_to_write_off = write_off_amount * tax_lot['Purchase Price in USD']
-                        final_df.loc[idx, 'Amount'] -= write_off_amount
-                        final_df.loc[idx, 'Cost Basis in USD'] -= cost_basis_to_write_off
-                        final_df.loc[idx, 'Year End Value in USD'] -= write_off_amount * tax_lot['Year End Price in USD']
-                        final_df.loc[idx, 'Gain/Loss in USD'] -= write_off_amount * (tax_lot['Year End Price in USD'] - tax_lot['Purchase Price in USD'])
-                        if final_df.loc[idx, 'Amount'] <= 1e-8:
-                            final_df.loc[idx, 'Amount'] = 0
-                            remaining_cost_basis = final_df.loc[idx, 'Cost Basis in USD']
-                            if remaining_cost_basis > 1e-8:
-                                cost_basis_to_write_off += remaining_cost_basis
-                                final_df.loc[idx, 'Cost Basis in USD'] = 0
-                                final_df.loc[idx, 'Gain/Loss in USD'] = 0
-                            final_df.loc[idx, 'comments'] = f"Exhausted {write_off_amount:.8f} {currency}; originally held {tax_lot['Amount']:.8f} {currency}; written off to match balance by exchange"
-                        else:
-                            final_df.loc[idx, 'comments'] = f"Wrote off {write_off_amount:.8f} {currency} to match balance by exchange"
-                        write_off_details.append({
+                    zero_price = (purchase_prices == 0) & (cost_bases != 0)
+                    cost_basis_to_write_off = np.where(zero_price, cost_bases * (write_off_amounts / amounts), write_off_amounts * purchase_prices)
+                    store.write_off(lots, write_off_amounts, cost_basis_to_write_off)
+                    exhausted, leftover = store.close_exhausted(lots)
+                    cost_basis_to_write_off += leftover
+                    
+                    store.comment(lots, [
+                        f"Exhausted {written_off:.8f} {currency}; originally held {held:.8f} {currency}; written off to match balance by exchange"
+                        if is_exhausted else f"Wrote off {written_off:.8f} {currency} to match balance by exchange"
+                        for written_off, held, is_exhausted in zip(write_off_amounts, amounts, exhausted)
+                    ])
+                    write_off_details.extend(
+                        {
                             'Currency': currency,
                             'Account': account,
-                            'Amount Written Off': write_off_amount,
-                            'Cost Basis Written Off in USD': cost_basis_to_write_off,
+                            'Amount Written Off': written_off,
+                            'Cost Basis Written Off in USD': cost_basis,
                             'Reason': 'Excess adjustment to match balance by exchange'
-                        })
-                        remaining -= write_off_amount
-    
-    final_df['Calculated Cost Basis'] = final_df['Amount'] * final_df['Purchase Price in USD']
-    inconsistencies = final_df[abs(final_df['Cost Basis in USD'] - final_df['Calculated Cost Basis']) > 1e-8]
-    if not inconsistencies.empty:
-        logging.warning("Data inconsistencies found in final_df after global adjustments:")
-        logging.warning(inconsistencies[['Amount', 'Purchase Price in USD', 'Cost Basis in USD', 'Calculated Cost Basis']])
+                        }
+                        for written_off, cost_basis in zip(write_off_amounts.tolist(), cost_basis_to_write_off.tolist())
+                    )
+                    record(currency, account, -write_off_amounts.sum())
     
-    logging.info("Global adjustments completed.")
-    return final_df, pd.DataFrame(write_off_details), pd.DataFrame(manual_entries)
+    _warn_inconsistencies(store, "final_df after global adjustments")
+    _log().info("Global adjustments completed.")
+    return pd.DataFrame(write_off_details), pd.DataFrame(manual_entries)
 
-def add_comments(final_df, discrepancies):
-    logging.info("Adding comments to adjusted closing position.")
+def resolve_global_adjustments(adjusted_df, global_discrepancies, balance_df):
+    store = TaxLotStore.from_frame(adjusted_df)
+    write_off_details, manual_entries = resolve_global_lots(store, global_discrepancies, balance_df)
+    return lots_frame(store), write_off_details, manual_entries
+
+def _reconcile_currency(closing_part, balance_part, discrepancies_part, global_part, log_level=logging.DEBUG):
+    # Runs in a worker process. Both stages only append rows, so the result frames are
+    # the partition's closing rows, then its reallocated lots, then its manual entries.
+    # Manual entries are returned as built, since a currency without closing rows would
+    # otherwise hand back an empty frame's placeholder dtypes. Log records are collected
+    # and sent back with the result, for the run's logger to emit.
+    worker_logger = collecting_logger(__name__, log_level, FLOAT_FORMAT)
+    with logging_to(worker_logger):
+        store = TaxLotStore.from_frame(closing_part)
+        reallocation_part = reallocate_lots(store, discrepancies_part, balance_part)
+        adjusted_part = lots_frame(store)
+        write_off_part, manual_part = resolve_global_lots(store, global_part, balance_part)
+        final_part = lots_frame(store)
+    n_lots, n_new = len(closing_part), len(reallocation_part)
+    return {
+        'adjusted_lots': adjusted_part.iloc[:n_lots],
+        'adjusted_new': adjusted_part.iloc[n_lots:],
+        'final_lots': final_part.iloc[:n_lots],
+        'final_new': final_part.iloc[n_lots:n_lots + n_new],
+        'reallocation_details': reallocation_part,
+        'write_off_details': write_off_part,
+        'manual_entries': manual_part,
+        'log_records': collected_records(worker_logger),
+    }
+
+def _concat_parts(parts, **kwargs):
+    parts = [part for part in parts if not part.empty]
+    return pd.concat(parts, **kwargs) if parts else pd.DataFrame()
+
+def reconcile_by_currency(closing_df, balance_df, discrepancies, global_discrepancies, workers=None):
+    """
+    Runs reallocate_excess and resolve_global_adjustments for each currency in a process pool.
+
+    The frames are split by Currency and merged back in the order the serial run
+    produces: closing rows in their original order, then reallocated lots in
+    discrepancy order, then manual entries in global discrepancy order, so the
+    results are identical to calling the two functions on the whole frames.
+    Every partition also gets the first balance row of each (account, account type),
+    since account types are looked up across all currencies.
+
+    Returns:
+        adjusted_df, reallocation_details, final_df, write_off_details, manual_entries
+    """
+    _log().info("Reconciling currencies in parallel.")
+    currencies = list(dict.fromkeys(list(discrepancies['Currency'].unique()) + list(global_discrepancies['Currency'].unique())))
+    closing_groups = closing_df.groupby('Currency', sort=False).indices
+    balance_groups = balance_df.groupby('Currency', sort=False).indices
+    account_type_rows = np.flatnonzero(~balance_df.duplicated(['Account', 'Account Type']).to_numpy())
+    empty = np.array([], dtype=np.int64)
+
+    closing_positions = [closing_groups.get(currency, empty) for currency in currencies]
+    partitions = [
+        (
+            closing_df.iloc[positions],
+            balance_df.iloc[np.union1d(balance_groups.get(currency, empty), account_type_rows)],
+            discrepancies[discrepancies['Currency'] == currency],
+            global_discrepancies[global_discrepancies['Currency'] == currency],
+        )
+        for currency, positions in zip(currencies, closing_positions)
+    ]
+    log_levels = [_log().getEffectiveLevel()] * len(partitions)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_reconcile_currency, *zip(*partitions), log_levels)) if partitions else []
+    for result in results:
+        replay_records(_log(), result['log_records'])
+
+    # Closing rows of currencies without discrepancies pass through unchanged
+    positions = np.concatenate(closing_positions + [empty])
+    passthrough = np.setdiff1d(np.arange(len(closing_df)), positions)
+    positions = np.concatenate([positions, passthrough])
+    order = np.argsort(positions, kind='stable')
+
+    def merge_lots(lots_key, tail_keys):
+        # Empty parts are skipped so their placeholder dtypes don't leak into the merge
+        lots = [result[lots_key] for result in results] + [closing_df.iloc[passthrough]]
+        lots = _concat_parts(lots).iloc[order] if len(closing_df) else closing_df.copy()
+        lots.index = closing_df.index
+        tails = [result[key] for key in tail_keys for result in results]
+        if not any(len(tail) for tail in tails):
+            return lots
+        return _concat_parts([lots] + tails, ignore_index=True)
+
+    adjusted_df = merge_lots('adjusted_lots', ['adjusted_new'])
+    final_df = merge_lots('final_lots', ['final_new', 'manual_entries'])
+    for df in (adjusted_df, final_df):
+        df['Calculated Cost Basis'] = df['Amount'] * df['Purchase Price in USD']
+
+    reallocation_details = _concat_parts([result['reallocation_details'] for result in results], ignore_index=True)
+    write_off_details = _concat_parts([result['write_off_details'] for result in results], ignore_index=True)
+    manual_entries = _concat_parts([result['manual_entries'] for result in results], ignore_index=True)
+    _log().info("Parallel reconciliation completed.")
+    return adjusted_df, reallocation_details, final_df, write_off_details, manual_entries
+
+def add_lot_comments(store, discrepancies):
+    """Comments the uncommented lots of accounts without a discrepancy."""
+    _log().info("Adding comments to adjusted closing position.")
+    groups = store.groups()
     for _, row in discrepancies.iterrows():
-        currency, account = row['Currency'], row['Account']
         if abs(row['Discrepancy']) < 1e-8:
-            final_df.loc[
-                (final_df['Currency'] == currency) & 
-                (final_df['Account'] == account) & 
-                (final_df['comments'] == ''),
-                'comments'
-            ] = f"No discrepancy; balance matches balance by exchange"
-        elif final_df[(final_df['Currency'] == currency) & (final_df['Account'] == account)].empty:
-            final_df.loc[
-                (final_df['Currency'] == currency) & 
-                (final_df['Account'] == account) & 
-                (final_df['comments'] == ''),
-                'comments'
-            ] = f"No tax lots used; not present in adjusted closing position"
-    logging.info("Comments added.")
-    return final_df
+            lots = groups.get((row['Currency'], row['Account']), np.array([], dtype=np.int64))
+            lots = lots[store.comments[lots] == '']
+            store.comment(lots, ["No discrepancy; balance matches balance by exchange"] * len(lots))
+    _log().info("Comments added.")
+
+def add_comments(final_df, discrepancies):
+    store = TaxLotStore.from_frame(final_df)
+    add_lot_comments(store, discrepancies)
+    return store.to_frame()
 
 def generate_cost_basis_summary(original_df, adjusted_df, write_off_details):
-    logging.info("Generating cost basis summary (requested columns).")
+    _log().info("Generating cost basis summary (requested columns).")
     pre_amount = original_df.groupby('Currency', as_index=False)['Amount'].sum() \
         .rename(columns={'Amount': 'Total Amount Before Write-Off'})
     pre_basis = original_df.groupby('Currency', as_index=False)['Cost Basis in USD'].sum() \
@@ -482,23 +570,24 @@ def generate_cost_basis_summary(original_df, adjusted_df, write_off_details):
         'Adjusted Total Cost Basis (USD)'
     ]
     df = df[cols].sort_values('Currency').reset_index(drop=True)
-    logging.info("Cost basis summary generated (requested columns).")
+    _log().info("Cost basis summary generated (requested columns).")
     return df
 
-def save_combined_report(output_path, raw_balance_df, raw_closing_df, discrepancies_simple, global_discrepancies, adjusted_df, cost_basis_summary, write_off_details, reallocation_details, manual_entries, original_df):
-    logging.info("Saving combined workbook.")
+def save_combined_report(output_path, raw_balance_df, raw_closing_df, discrepancies_simple, global_discrepancies, adjusted_df, cost_basis_summary, write_off_details, reallocation_details, manual_entries, original_df, report_format='xlsx', include_raw_sheets=True):
+    """Writes the combined report in report_format (see report_writer.open_report) and returns its path."""
+    _log().info("Saving combined workbook.")
     original_cost_basis_tmp = adjusted_df['Cost Basis in USD'].sum()
     if (adjusted_df['Cost Basis in USD'] < 0).any():
         adjusted_df.loc[adjusted_df['Cost Basis in USD'] < 0, 'Cost Basis in USD'] = 0
-        logging.warning("Negative cost basis values detected and corrected to 0.")
+        _log().warning("Negative cost basis values detected and corrected to 0.")
     zero_amount_with_cost = adjusted_df[(adjusted_df['Amount'] <= 1e-8) & (abs(adjusted_df['Cost Basis in USD']) > 1e-8)]
     if not zero_amount_with_cost.empty:
-        logging.warning(f"Zero-amount entries with significant cost basis detected: {zero_amount_with_cost[['Amount', 'Cost Basis in USD']]}")
+        _log().warning("Zero-amount entries with significant cost basis detected: %s", zero_amount_with_cost[['Amount', 'Cost Basis in USD']])
         adjusted_df.loc[(adjusted_df['Amount'] <= 1e-8) & (abs(adjusted_df['Cost Basis in USD']) > 1e-8), 'Cost Basis in USD'] = 0
         adjusted_df.loc[(adjusted_df['Amount'] <= 1e-8) & (abs(adjusted_df['Cost Basis in USD']) > 1e-8), 'Gain/Loss in USD'] = 0
     adjusted_df['Gain/Loss in USD'] = adjusted_df['Year End Value in USD'] - adjusted_df['Cost Basis in USD']
     new_cost_basis_tmp = adjusted_df['Cost Basis in USD'].sum()
-    logging.info(f"Cost basis validation - Original: {original_cost_basis_tmp:.8f}, New: {new_cost_basis_tmp:.8f}, Difference: {(new_cost_basis_tmp - original_cost_basis_tmp):.8f}")
+    _log().info(f"Cost basis validation - Original: {original_cost_basis_tmp:.8f}, New: {new_cost_basis_tmp:.8f}, Difference: {(new_cost_basis_tmp - original_cost_basis_tmp):.8f}")
     original_total_cost_basis = original_df['Cost Basis in USD'].sum()
     write_off_total_cost_basis = write_off_details['Cost Basis Written Off in USD'].sum() if not write_off_details.empty else 0.0
     adjusted_total_cost_basis = adjusted_df['Cost Basis in USD'].sum()
@@ -525,42 +614,44 @@ def save_combined_report(output_path, raw_balance_df, raw_closing_df, discrepanc
     summary_dist['Changes'] = summary_dist[['Written Off (USD)', 'Adjusted Cost Basis (USD)', 'Manual Added (Amount)']].sum(axis=1)
     summary_dist = summary_dist[summary_dist['Changes'] > 1e-8].drop('Changes', axis=1)
     
-    output_file = os.path.join(output_path, "Combined Report.xlsx")
-    with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
-        raw_closing_df.to_excel(writer, sheet_name="Original Closing Position", index=False)
-        raw_balance_df.to_excel(writer, sheet_name="Original Balance by Exchange", index=False)
-        adjusted_df.to_excel(writer, sheet_name="Adjusted Closing Position", index=False)
-        discrepancies_simple.to_excel(writer, sheet_name="Account-Level Discrepancies", index=False)
-        global_discrepancies.to_excel(writer, sheet_name="Global Discrepancies", index=False)
-        cost_basis_summary.to_excel(writer, sheet_name="Cost Basis Summary", index=False)
+    with open_report(output_path, "Combined Report", report_format) as report:
+        if include_raw_sheets:
+            report.write("Original Closing Position", raw_closing_df)
+            report.write("Original Balance by Exchange", raw_balance_df)
+        report.write("Adjusted Closing Position", adjusted_df)
+        report.write("Account-Level Discrepancies", discrepancies_simple)
+        report.write("Global Discrepancies", global_discrepancies)
+        report.write("Cost Basis Summary", cost_basis_summary)
         if not write_off_details.empty:
-            write_off_details.to_excel(writer, sheet_name="Write-Off Details", index=False)
+            report.write("Write-Off Details", write_off_details)
         if not reallocation_details.empty:
-            reallocation_details.to_excel(writer, sheet_name="Reallocation Details", index=False)
+            report.write("Reallocation Details", reallocation_details)
         if not manual_entries.empty:
-            manual_entries.to_excel(writer, sheet_name="Manual Entries", index=False)
-        summary_top.to_excel(writer, sheet_name="Summary", index=False)
-        summary_dist.to_excel(writer, sheet_name="Summary", startrow=len(summary_top) + 2, index=False)
-    logging.info(f"Combined report saved to {output_file}")
+            report.write("Manual Entries", manual_entries)
+        report.write("Summary", summary_top)
+        report.write("Summary", summary_dist, startrow=len(summary_top) + 2)
+    _log().info(f"Combined report saved to {report.path}")
+    return report.path
 
 
 def generate_final_adjusted_closing_report(output_path, adjusted_df):
-    logging.info("Generating Final Adjusted Closing Position.csv.")
-    adjusted_df.to_csv(os.path.join(output_path, "Updated Closing Position Report.csv"), index=False)
+    _log().info("Generating Final Adjusted Closing Position.csv.")
+    write_csv(output_path, "Updated Closing Position Report.csv", adjusted_df)
     return adjusted_df
 
-def generate_tax_lot_consolidation_details(output_path, adjusted_df):
-    logging.info("Generating Tax Lot Consolidation Details.xlsx.")
+def generate_tax_lot_consolidation_details(output_path, adjusted_df, report_format='xlsx'):
+    _log().info("Generating Tax Lot Consolidation Details.xlsx.")
     df = adjusted_df[adjusted_df['comments'].str.contains("reallocated|written off|Manual")].copy()
     if not df.empty:
-        df.to_excel(os.path.join(output_path, "Tax Lot Consolidation Details.xlsx"), index=False)
+        with open_report(output_path, "Tax Lot Consolidation Details", report_format) as report:
+            report.write("Sheet1", df)
     else:
-        logging.info("No tax lot consolidations to report.")
+        _log().info("No tax lot consolidations to report.")
 
-def generate_cost_basis_change_analysis(output_path, adjusted_df, final_adjusted_df):
-    logging.info("Generating Cost Basis Change Analysis.xlsx.")
+def generate_cost_basis_change_analysis(output_path, adjusted_df, final_adjusted_df, report_format='xlsx'):
+    _log().info("Generating Cost Basis Change Analysis.xlsx.")
     if final_adjusted_df.empty:
-        logging.warning("Final adjusted DataFrame is empty. Skipping Cost Basis Change Analysis.")
+        _log().warning("Final adjusted DataFrame is empty. Skipping Cost Basis Change Analysis.")
         return
     df_adjusted = adjusted_df[['Currency', 'Account', 'Amount', 'Cost Basis in USD']].copy()
     df_final = final_adjusted_df[['Currency', 'Account', 'Amount', 'Cost Basis in USD']].copy()
@@ -572,15 +663,16 @@ def generate_cost_basis_change_analysis(output_path, adjusted_df, final_adjusted
         (merged_df['Cost Basis Change'].abs() > 1e-8)
     ]
     if not changes_df.empty:
-        changes_df.to_excel(os.path.join(output_path, "Cost Basis Change Analysis.xlsx"), index=False)
+        with open_report(output_path, "Cost Basis Change Analysis", report_format) as report:
+            report.write("Sheet1", changes_df)
     else:
-        logging.info("No significant cost basis changes to report.")
+        _log().info("No significant cost basis changes to report.")
 
 def generate_cointracking_import_file(output_path, final_adjusted_df, raw_closing_df, raw_balance_df):
-    logging.info("Generating CoinTracking Import File.csv.")
+    _log().info("Generating CoinTracking Import File.csv.")
     
     if final_adjusted_df.empty:
-        logging.warning("Final adjusted DataFrame is empty. Skipping CoinTracking import file generation.")
+        _log().warning("Final adjusted DataFrame is empty. Skipping CoinTracking import file generation.")
         return
     
     df = final_adjusted_df.copy()
@@ -610,26 +702,63 @@ def generate_cointracking_import_file(output_path, final_adjusted_df, raw_closin
     ]
     cointracking_df = cointracking_df[final_cols]
     
-    cointracking_df.to_csv(os.path.join(output_path, "CoinTracking Import File.csv"), index=False)
+    write_csv(output_path, "CoinTracking Import File.csv", cointracking_df)
+    return cointracking_df
 
-def main(closing_file_object, balance_file_object, output_path):
-    logging.info("Starting main process.")
-    try:
+def run_reconciliation(closing_file_object, balance_file_object, output_path, workers=1, report_format='xlsx', include_raw_sheets=True, recorder=None):
+    """
+    Runs the reconciliation and writes the reports to output_path (a directory or a
+    report_writer.OutputBundle). Errors are raised.
+
+    The stages (load, discrepancies, reallocation, global adjustments, comments and
+    report writing) are timed into recorder, an instrumentation.StageRecorder, if given.
+    With workers > 1 reallocation and global adjustments run together as one stage.
+
+    Returns:
+        The combined report path, the adjusted closing report path, the final adjusted
+        closing position and the CoinTracking import frame (None if it is empty).
+    """
+    with recording(recorder):
+        return _run_stages(closing_file_object, balance_file_object, output_path, workers, report_format, include_raw_sheets)
+
+def _run_stages(closing_file_object, balance_file_object, output_path, workers, report_format, include_raw_sheets):
+    with stage("load") as record:
         raw_closing_df, raw_balance_df, closing_df, balance_df = load_data(closing_file_object, balance_file_object)
-        
+        record["rows_out"] = len(closing_df) + len(balance_df)
+    
+    with stage("discrepancies", closing_df) as record:
         discrepancies_simple, global_discrepancies = calculate_discrepancies(closing_df, balance_df)
+        record["rows_out"] = discrepancies_simple
+    
+    if workers == 1:
+        store = TaxLotStore.from_frame(closing_df)
+        with stage("reallocation", closing_df) as record:
+            reallocation_details = reallocate_lots(store, discrepancies_simple, balance_df)
+            adjusted_df = lots_frame(store)
+            record["rows_out"] = adjusted_df
         
-        adjusted_df, reallocation_details = reallocate_excess(closing_df, discrepancies_simple, balance_df)
-        
-        final_adjusted_df, write_off_details, manual_entries = resolve_global_adjustments(adjusted_df, global_discrepancies, balance_df)
-        
-        final_adjusted_df = add_comments(final_adjusted_df, discrepancies_simple)
-        
-        _validate_all_dates(final_adjusted_df)
-        
+        with stage("global adjustments", adjusted_df) as record:
+            write_off_details, manual_entries = resolve_global_lots(store, global_discrepancies, balance_df)
+            record["rows_out"] = len(store)
+    else:
+        with stage("reallocation and global adjustments", closing_df) as record:
+            adjusted_df, reallocation_details, final_adjusted_df, write_off_details, manual_entries = reconcile_by_currency(
+                closing_df, balance_df, discrepancies_simple, global_discrepancies, workers
+            )
+            record["rows_out"] = final_adjusted_df
+        store = TaxLotStore.from_frame(final_adjusted_df)
+    
+    with stage("comments", len(store)) as record:
+        add_lot_comments(store, discrepancies_simple)
+        final_adjusted_df = lots_frame(store)
+        record["rows_out"] = final_adjusted_df
+    
+    _validate_all_dates(final_adjusted_df)
+    
+    with stage("report writing", final_adjusted_df):
         cost_basis_summary = generate_cost_basis_summary(closing_df, final_adjusted_df, write_off_details)
 
-        save_combined_report(
+        combined_report_path = save_combined_report(
             output_path,
             raw_balance_df,
             raw_closing_df,
@@ -640,30 +769,168 @@ def main(closing_file_object, balance_file_object, output_path):
             write_off_details,
             reallocation_details,
             manual_entries,
-            closing_df
+            closing_df,
+            report_format,
+            include_raw_sheets
         )
         
         final_adjusted_df_from_report = generate_final_adjusted_closing_report(output_path, final_adjusted_df)
-        generate_tax_lot_consolidation_details(output_path, final_adjusted_df)
-        generate_cost_basis_change_analysis(output_path, adjusted_df, final_adjusted_df_from_report)
-        generate_cointracking_import_file(output_path, final_adjusted_df_from_report, raw_closing_df, raw_balance_df)
+        generate_tax_lot_consolidation_details(output_path, final_adjusted_df, report_format)
+        generate_cost_basis_change_analysis(output_path, adjusted_df, final_adjusted_df_from_report, report_format)
+        cointracking_df = generate_cointracking_import_file(output_path, final_adjusted_df_from_report, raw_closing_df, raw_balance_df)
 
-        combined_report_path = os.path.join(output_path, "Combined Report.xlsx")
-        adjusted_closing_path = os.path.join(output_path, "Updated Closing Position Report 2024.csv")
-        
-        logging.info("Script execution completed.")
-        return combined_report_path, adjusted_closing_path, None
+    adjusted_closing_path = as_output(output_path).path_of("Updated Closing Position Report.csv")
+    return combined_report_path, adjusted_closing_path, final_adjusted_df_from_report, cointracking_df
 
-    except Exception as e:
-        error_traceback = traceback.format_exc()
-        logging.error(f"Main process failed: {str(e)}")
-        logging.error(error_traceback)
-        return None, None, error_traceback
+class ReconciliationEngine:
+    """
+    Runs reconciliations with fixed settings and no process-wide side effects.
+
+    Each run logs to a logger of its own. The log is returned with the results and
+    also written to log_stream if one is given. DataFrames in the log are formatted
+    with float_format rather than pandas' global display options. Nothing is shared
+    between runs, so one engine can serve many reconciliations at once, e.g. from a
+    thread pool in a server process.
+
+    With workers > 1 (or None for the CPU count), currencies are reallocated and
+    adjusted in parallel by reconcile_by_currency; the reports are the same.
+    report_format picks the report backend ('xlsx', 'csv', 'parquet' or 'feather'),
+    and include_raw_sheets=False leaves the copies of the input files out of the
+    combined report.
+    """
+
+    def __init__(self, workers=1, report_format='xlsx', include_raw_sheets=True,
+                 log_level=logging.DEBUG, log_stream=None, float_format=FLOAT_FORMAT):
+        self.workers = workers
+        self.report_format = report_format
+        self.include_raw_sheets = include_raw_sheets
+        self.log_level = log_level
+        self.log_stream = log_stream
+        self.float_format = float_format
+
+    def _run_logger(self):
+        return run_logger(__name__, self.log_stream, self.log_level, self.float_format)
+
+    def run(self, closing_file_object, balance_file_object, output_path, recorder=None):
+        """
+        Runs the reconciliation and writes the reports to output_path, a directory or a
+        report_writer.OutputBundle. Pass an instrumentation.StageRecorder as recorder to
+        get the time, rows and peak memory of each stage.
+
+        Returns:
+            combined_report_path, adjusted_closing_path, error_traceback, log
+        """
+        run_log = self._run_logger()
+        with logging_to(run_log):
+            _log().info("Starting main process.")
+            try:
+                combined_report_path, adjusted_closing_path, _, _ = run_reconciliation(
+                    closing_file_object, balance_file_object, output_path, self.workers, self.report_format,
+                    self.include_raw_sheets, recorder
+                )
+                
+                _log().info("Script execution completed.")
+                return combined_report_path, adjusted_closing_path, None, log_text(run_log)
+
+            except Exception as e:
+                error_traceback = traceback.format_exc()
+                _log().error(f"Main process failed: {str(e)}")
+                _log().error(error_traceback)
+                return None, None, error_traceback, log_text(run_log)
+
+    def run_in_memory(self, closing_file_object, balance_file_object, zipped=False, recorder=None):
+        """
+        Like run(), but keeps the reports in memory instead of writing them to a directory.
+
+        With zipped=True the reports come back as one zip archive in a BytesIO, and each
+        report is compressed in the background while the next one is generated.
+
+        Returns:
+            bundle, combined_report_name, adjusted_closing_name, error_traceback, log
+            where bundle is a dict of file name -> BytesIO, or the zip BytesIO, and the
+            names are the bundle's file names for the two main reports.
+        """
+        output = OutputBundle(zipped)
+        combined_report_name, adjusted_closing_name, error_traceback, log = self.run(
+            closing_file_object, balance_file_object, output, recorder
+        )
+        bundle = output.close()
+        if error_traceback is not None:
+            return None, None, None, error_traceback, log
+        return bundle, combined_report_name, adjusted_closing_name, None, log
+
+    def run_with_comparison(self, closing_file_object, balance_file_object, output_path, recorder=None):
+        """
+        Runs the reconciliation and then the WBW2 comparison on its results in one go.
+
+        The final adjusted closing position and the CoinTracking import are handed to
+        WBW2 as DataFrames instead of being read back from the CSVs run() writes, so
+        there is no download/re-upload step. The comparison workbook goes to output_path too.
+
+        Returns:
+            combined_report_path, adjusted_closing_path, comparison_report_path, error_traceback, log
+        """
+        run_log = self._run_logger()
+        with logging_to(run_log):
+            _log().info("Starting main process with CoinTracking comparison.")
+            try:
+                combined_report_path, adjusted_closing_path, final_adjusted_df, cointracking_df = run_reconciliation(
+                    closing_file_object, balance_file_object, output_path, self.workers, self.report_format,
+                    self.include_raw_sheets, recorder
+                )
+                if cointracking_df is None:
+                    raise ValueError("The final adjusted closing position is empty, so there is no CoinTracking import to compare.")
+                with recording(recorder), stage("comparison", final_adjusted_df):
+                    comparison_report_path = WBW2.write_comparison(
+                        final_adjusted_df, cointracking_df, output_path, self.report_format, self.include_raw_sheets
+                    )
+                
+                _log().info("Script execution completed.")
+                return combined_report_path, adjusted_closing_path, comparison_report_path, None, log_text(run_log)
+
+            except Exception as e:
+                error_traceback = traceback.format_exc()
+                _log().error(f"Main process failed: {str(e)}")
+                _log().error(error_traceback)
+                return None, None, None, error_traceback, log_text(run_log)
+
+
+# The functions below run one reconciliation with its log going to stdout.
+# See ReconciliationEngine for the arguments.
+def main(closing_file_object, balance_file_object, output_path, workers=1, report_format='xlsx', include_raw_sheets=True, recorder=None):
+    """
+    Runs the reconciliation and writes the reports to output_path.
+
+    Returns:
+        combined_report_path, adjusted_closing_path, error_traceback
+    """
+    engine = ReconciliationEngine(workers, report_format, include_raw_sheets, log_stream=sys.stdout)
+    return engine.run(closing_file_object, balance_file_object, output_path, recorder)[:-1]
+
+def main_in_memory(closing_file_object, balance_file_object, workers=1, report_format='xlsx', include_raw_sheets=True, zipped=False, recorder=None):
+    """
+    Like main(), but keeps the reports in memory (see ReconciliationEngine.run_in_memory).
+
+    Returns:
+        bundle, combined_report_name, adjusted_closing_name, error_traceback
+    """
+    engine = ReconciliationEngine(workers, report_format, include_raw_sheets, log_stream=sys.stdout)
+    return engine.run_in_memory(closing_file_object, balance_file_object, zipped, recorder)[:-1]
+
+def main_with_comparison(closing_file_object, balance_file_object, output_path, workers=1, report_format='xlsx', include_raw_sheets=True, recorder=None):
+    """
+    Runs main() and then the WBW2 comparison on its results in one go.
+
+    Returns:
+        combined_report_path, adjusted_closing_path, comparison_report_path, error_traceback
+    """
+    engine = ReconciliationEngine(workers, report_format, include_raw_sheets, log_stream=sys.stdout)
+    return engine.run_with_comparison(closing_file_object, balance_file_object, output_path, recorder)[:-1]
 
 
 def _validate_all_dates(df):
     if not df.empty:
         invalid_dates = df['Date Acquired'].isna()
         if invalid_dates.any():
-            logging.warning("Invalid dates found after processing. These rows may have been skipped or need manual correction.")
-            logging.warning(df[invalid_dates])
\ No newline at end of file
+            _log().warning("Invalid dates found after processing. These rows may have been skipped or need manual correction.")
+            _log().warning(df[invalid_dates])
\ No newline at end of file
@@ -1,21 +1,23 @@
 # WBW2.py by Ali, improved by Anders
-import os
+import io
 import sys
 import logging
 import traceback
 import pandas as pd
 import numpy as np
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
-logging.info("Script started - logging initialized.")
+from instrumentation import current_logger, log_text, logging_to, run_logger
+from report_writer import open_report
 
-pd.set_option('display.float_format', '{:.8f}'.format)
+logger = logging.getLogger(__name__)
+
+# 8-decimal precision for DataFrames in the log
+FLOAT_FORMAT = '{:.8f}'.format
+
+
+def _log():
+    # Each run logs to its own logger (see ComparisonEngine); inside a WBW run, to that run's logger
+    return current_logger(logger)
 
 
 def _clean_numeric(series):
@@ -26,9 +28,12 @@ def _clean_numeric(series):
 
 
 def load_closing_csv(closing_file_path_or_object):
-    logging.info(f"Loading Updated Closing Position report.")
+    _log().info(f"Loading Updated Closing Position report.")
     raw = pd.read_csv(closing_file_path_or_object)
-    
+    return raw, aggregate_closing(raw)
+
+
+def aggregate_closing(raw):
     cols_map = {c.lower(): c for c in raw.columns}
     col_currency = cols_map.get('currency', 'Currency')
     col_account_like = None
@@ -69,13 +74,16 @@ def load_closing_csv(closing_file_path_or_object):
             .rename(columns={'_Currency': 'Currency', '_Account': 'Account'})
     )
 
-    return raw, closing_agg
+    return closing_agg
 
 
 def load_cointracking_csv(ct_file_path_or_object):
-    logging.info(f"Loading CoinTracking import from.")
+    _log().info(f"Loading CoinTracking import from.")
     raw = pd.read_csv(ct_file_path_or_object)
+    return raw, aggregate_cointracking(raw)
+
 
+def aggregate_cointracking(raw):
     cols_map = {c.lower(): c for c in raw.columns}
     col_buy_amt = cols_map.get('buy amount', 'Buy Amount')
     col_buy_cur = cols_map.get('buy cur.', 'Buy Cur.')
@@ -104,7 +112,7 @@ def load_cointracking_csv(ct_file_path_or_object):
             .rename(columns={'_Currency': 'Currency', '_Account': 'Account'})
     )
 
-    return raw, ct_agg
+    return ct_agg
 
 
 def build_detailed_comparison(closing_agg, ct_agg):
@@ -172,31 +180,92 @@ def build_cost_basis_summary(closing_agg, ct_agg):
     return summary_df
 
 
-def main(closing_file_object, ct_file_object, output_path):
-    logging.info("Starting main process for WBW2.")
-    try:
-        out_xlsx = os.path.join(output_path, "New Closing Position vs CoinTracking Import.xlsx")
-
-        raw_closing, closing_agg = load_closing_csv(closing_file_object)
-        raw_ct, ct_agg = load_cointracking_csv(ct_file_object)
-
-        detailed = build_detailed_comparison(closing_agg, ct_agg)
-
-        global_comp = build_global_comparison(detailed)
-
-        cb_summary = build_cost_basis_summary(closing_agg, ct_agg)
-
-        with pd.ExcelWriter(out_xlsx, engine='openpyxl') as writer:
-            raw_closing.to_excel(writer, sheet_name="Updated Closing Position", index=False)
-            raw_ct.to_excel(writer, sheet_name="CoinTracking Import", index=False)
-            detailed.to_excel(writer, sheet_name="Comparison", index=False)
-            global_comp.to_excel(writer, sheet_name="Global Comparison", index=False)
-            cb_summary.to_excel(writer, sheet_name="Cost Basis Summary", index=False)
-        logging.info(f"Comparison workbook saved to {out_xlsx}")
-    except Exception as e:
-        error_traceback = traceback.format_exc()
-        logging.error(f"Main process failed: {str(e)}")
-        logging.error(error_traceback)
-        return None, error_traceback
-
-    return out_xlsx, None
\ No newline at end of file
+def _dates_as_csv_text(df):
+    # Frames handed over from WBW still have datetime columns; show them as the text
+    # they'd be read back as from WBW's CSVs, so the raw sheets match the two-step flow
+    dates = df.select_dtypes(include=['datetime', 'datetimetz']).columns
+    if len(dates) == 0:
+        return df
+    df = df.copy()
+    round_trip = pd.read_csv(io.StringIO(df[dates].to_csv(index=False)))
+    for col in dates:
+        df[col] = round_trip[col].to_numpy()
+    return df
+
+
+def write_comparison(raw_closing, raw_ct, output_path, report_format='xlsx', include_raw_sheets=True, closing_agg=None, ct_agg=None):
+    """
+    Compares a closing position with a CoinTracking import and writes the comparison workbook.
+
+    raw_closing and raw_ct can come straight from WBW (see WBW.main_with_comparison)
+    instead of being read back from the CSVs it writes. Returns the workbook's path.
+    """
+    if closing_agg is None:
+        closing_agg = aggregate_closing(raw_closing)
+    if ct_agg is None:
+        ct_agg = aggregate_cointracking(raw_ct)
+
+    detailed = build_detailed_comparison(closing_agg, ct_agg)
+
+    global_comp = build_global_comparison(detailed)
+
+    cb_summary = build_cost_basis_summary(closing_agg, ct_agg)
+
+    # report_format and include_raw_sheets work as in WBW.main
+    with open_report(output_path, "New Closing Position vs CoinTracking Import", report_format) as report:
+        if include_raw_sheets:
+            report.write("Updated Closing Position", _dates_as_csv_text(raw_closing))
+            report.write("CoinTracking Import", _dates_as_csv_text(raw_ct))
+        report.write("Comparison", detailed)
+        report.write("Global Comparison", global_comp)
+        report.write("Cost Basis Summary", cb_summary)
+    _log().info(f"Comparison workbook saved to {report.path}")
+    return report.path
+
+
+class ComparisonEngine:
+    """
+    Runs comparisons with fixed settings and no process-wide side effects.
+
+    Each run logs to a logger of its own; the log is returned with the results and
+    also written to log_stream if one is given. One engine can serve many comparisons
+    at once, e.g. from a thread pool in a server process.
+    """
+
+    def __init__(self, report_format='xlsx', include_raw_sheets=True,
+                 log_level=logging.DEBUG, log_stream=None, float_format=FLOAT_FORMAT):
+        self.report_format = report_format
+        self.include_raw_sheets = include_raw_sheets
+        self.log_level = log_level
+        self.log_stream = log_stream
+        self.float_format = float_format
+
+    def run(self, closing_file_object, ct_file_object, output_path):
+        """
+        Compares a closing position CSV with a CoinTracking import CSV and writes the
+        comparison workbook to output_path, a directory or a report_writer.OutputBundle.
+
+        Returns:
+            comparison_report_path, error_traceback, log
+        """
+        run_log = run_logger(__name__, self.log_stream, self.log_level, self.float_format)
+        with logging_to(run_log):
+            _log().info("Starting main process for WBW2.")
+            try:
+                raw_closing, closing_agg = load_closing_csv(closing_file_object)
+                raw_ct, ct_agg = load_cointracking_csv(ct_file_object)
+
+                out_xlsx = write_comparison(raw_closing, raw_ct, output_path, self.report_format, self.include_raw_sheets, closing_agg, ct_agg)
+            except Exception as e:
+                error_traceback = traceback.format_exc()
+                _log().error(f"Main process failed: {str(e)}")
+                _log().error(error_traceback)
+                return None, error_traceback, log_text(run_log)
+
+            return out_xlsx, None, log_text(run_log)
+
+
+def main(closing_file_object, ct_file_object, output_path, report_format='xlsx', include_raw_sheets=True):
+    """Runs one comparison with its log going to stdout. Returns comparison_report_path, error_traceback."""
+    engine = ComparisonEngine(report_format, include_raw_sheets, log_stream=sys.stdout)
+    return engine.run(closing_file_object, ct_file_object, output_path)[:-1]
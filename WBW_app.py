@@ -4,9 +4,7 @@ import os
 import sys
 import shutil
 import importlib
-import tempfile
 import io
-from contextlib import redirect_stdout, redirect_stderr
 
 # To make sure we can import the scripts
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -15,6 +13,7 @@ sys.path.append(SCRIPT_DIR)
 # Dynamically import the main functions from the scripts
 wbw_module = importlib.import_module("WBW")
 wbw2_module = importlib.import_module("WBW2")
+from report_writer import OutputBundle
 
 def main():
     st.set_page_config(page_title="Wallet Transaction Analysis", layout="wide")
@@ -37,48 +36,43 @@ def main():
             
             # Placeholder for log output
             log_placeholder = st.empty()
-            log_stream = io.StringIO()
-
-            with redirect_stdout(log_stream):
-                with redirect_stderr(log_stream):
-                    try:
-                        # Read files into in-memory objects
-                        closing_data = io.BytesIO(closing_file_wbw.getvalue())
-                        balance_data = io.BytesIO(balance_file_wbw.getvalue())
-                        
-                        with tempfile.TemporaryDirectory() as temp_dir:
-                            # Pass in-memory objects and temporary output path to the script
-                            combined_report_path, adjusted_closing_path, error_traceback = wbw_module.main(closing_data, balance_data, temp_dir)
-
-                            if combined_report_path:
-                                st.success("WBW.py analysis completed successfully! Reports are available for download.")
-                                
-                                st.download_button(
-                                    label="Download Combined Report.xlsx",
-                                    data=open(combined_report_path, "rb").read(),
-                                    file_name="Combined Report.xlsx",
-                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                                )
-                                # Add download button for other files if needed
-                                # For example, adjusted_closing_path
-                                # if adjusted_closing_path:
-                                #     st.download_button(
-                                #         label="Download Updated Closing Position Report.csv",
-                                #         data=open(adjusted_closing_path, "rb").read(),
-                                #         file_name="Updated Closing Position Report.csv",
-                                #         mime="text/csv"
-                                #     )
-                            else:
-                                st.error("Analysis failed.")
-                                if error_traceback:
-                                    st.text_area("Error Details", error_traceback, height=300)
-
-                    except Exception as e:
-                        st.error(f"An unexpected error occurred: {e}")
-                        st.text_area("Error Details", traceback.format_exc(), height=300)
+            log_output = ""
+
+            try:
+                # Read files into in-memory objects
+                closing_data = io.BytesIO(closing_file_wbw.getvalue())
+                balance_data = io.BytesIO(balance_file_wbw.getvalue())
+                
+                # Reports are kept in memory, nothing is written to disk. The run logs
+                # to its own logger, so concurrent sessions don't mix their logs.
+                bundle, combined_report_name, adjusted_closing_name, error_traceback, log_output = \
+                    wbw_module.ReconciliationEngine().run_in_memory(closing_data, balance_data)
+
+                if bundle is not None:
+                    st.success("WBW.py analysis completed successfully! Reports are available for download.")
+                    
+                    st.download_button(
+                        label="Download Combined Report.xlsx",
+                        data=bundle[combined_report_name].getvalue(),
+                        file_name="Combined Report.xlsx",
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                    )
+                    st.download_button(
+                        label="Download Updated Closing Position Report.csv",
+                        data=bundle[adjusted_closing_name].getvalue(),
+                        file_name="Updated Closing Position Report.csv",
+                        mime="text/csv"
+                    )
+                else:
+                    st.error("Analysis failed.")
+                    if error_traceback:
+                        st.text_area("Error Details", error_traceback, height=300)
+
+            except Exception as e:
+                st.error(f"An unexpected error occurred: {e}")
+                st.text_area("Error Details", traceback.format_exc(), height=300)
             
-            # Display captured log output
-            log_output = log_stream.getvalue()
+            # Display the run's log
             if log_output:
                 log_placeholder.text_area("Script Log", log_output, height=400)
 
@@ -95,38 +89,36 @@ def main():
             
             # Placeholder for log output
             log_placeholder = st.empty()
-            log_stream = io.StringIO()
-
-            with redirect_stdout(log_stream):
-                with redirect_stderr(log_stream):
-                    try:
-                        # Read files into in-memory objects
-                        closing_data_wbw2 = io.BytesIO(closing_file_wbw2.getvalue())
-                        ct_data_wbw2 = io.BytesIO(ct_file_wbw2.getvalue())
-
-                        with tempfile.TemporaryDirectory() as temp_dir:
-                            # Pass in-memory objects and temporary output path to the script
-                            comparison_report_path, error_traceback = wbw2_module.main(closing_data_wbw2, ct_data_wbw2, temp_dir)
-
-                            if comparison_report_path:
-                                st.success("WBW2.py comparison completed successfully! Workbook is available for download.")
-                                st.download_button(
-                                    label="Download Comparison Workbook",
-                                    data=open(comparison_report_path, "rb").read(),
-                                    file_name="New Closing Position vs CoinTracking Import.xlsx",
-                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                                )
-                            else:
-                                st.error("Comparison failed.")
-                                if error_traceback:
-                                    st.text_area("Error Details", error_traceback, height=300)
-
-                    except Exception as e:
-                        st.error(f"An unexpected error occurred: {e}")
-                        st.text_area("Error Details", traceback.format_exc(), height=300)
+            log_output = ""
+
+            try:
+                # Read files into in-memory objects
+                closing_data_wbw2 = io.BytesIO(closing_file_wbw2.getvalue())
+                ct_data_wbw2 = io.BytesIO(ct_file_wbw2.getvalue())
+
+                # The workbook is kept in memory, nothing is written to disk
+                output = OutputBundle()
+                comparison_report_name, error_traceback, log_output = \
+                    wbw2_module.ComparisonEngine().run(closing_data_wbw2, ct_data_wbw2, output)
+
+                if comparison_report_name:
+                    st.success("WBW2.py comparison completed successfully! Workbook is available for download.")
+                    st.download_button(
+                        label="Download Comparison Workbook",
+                        data=output.close()[comparison_report_name].getvalue(),
+                        file_name="New Closing Position vs CoinTracking Import.xlsx",
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                    )
+                else:
+                    st.error("Comparison failed.")
+                    if error_traceback:
+                        st.text_area("Error Details", error_traceback, height=300)
+
+            except Exception as e:
+                st.error(f"An unexpected error occurred: {e}")
+                st.text_area("Error Details", traceback.format_exc(), height=300)
             
-            # Display captured log output
-            log_output = log_stream.getvalue()
+            # Display the run's log
             if log_output:
                 log_placeholder.text_area("Script Log", log_output, height=400)
 
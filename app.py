@@ -1,7 +1,8 @@
 # app.py
+import io
 import streamlit as st
-import pandas as pd
-from processing_logic import process_file, CONFIGS # We'll create CONFIGS in the next step
+from processing_logic import detect_config, CONFIGS # We'll create CONFIGS in the next step
+from format_cache import process_bytes_cached
 from balance import calculate_balances
 from rollforward_tool import generate_rollforward_summary
 
@@ -22,7 +23,8 @@ st.write(
 uploaded_file = st.file_uploader("Upload your CSV file", type="csv")
 
 # Create a dropdown menu from the names of your configurations
-config_options = list(CONFIGS.keys())
+AUTO_DETECT = "Auto-detect"
+config_options = [AUTO_DETECT] + list(CONFIGS.keys())
 selected_config_name = st.selectbox(
     "What is the format of the original file?",
     options=config_options
@@ -34,16 +36,23 @@ if st.button("Process File"):
     if uploaded_file is not None:
         with st.spinner("Processing your file... this may take a moment."):
             try:
-                # Read the uploaded CSV into a pandas DataFrame
-                input_df = pd.read_csv(uploaded_file)
+                # Raw bytes of the upload; the formatted result is cached by their hash
+                input_bytes = uploaded_file.getvalue()
                 
-                # Get the selected configuration dictionary
-                selected_config = CONFIGS[selected_config_name]
+                # Get the selected configuration dictionary, or detect it from the headers
+                if selected_config_name == AUTO_DETECT:
+                    detected_name, confidence = detect_config(io.BytesIO(input_bytes))
+                    if detected_name is None or confidence < 0.5:
+                        raise ValueError("Could not detect the file format. Please select it from the list.")
+                    st.info(f"Detected format: {detected_name} (confidence {confidence:.0%})")
+                    selected_config = CONFIGS[detected_name]
+                else:
+                    selected_config = CONFIGS[selected_config_name]
                 
-                # Call your existing processing function
-                output_df = process_file(input_df, selected_config)
+                # Call your existing processing function, or reuse the cached result for this file
+                output_df, cache_hit = process_bytes_cached(input_bytes, selected_config, file_name=uploaded_file.name)
                 
-                st.success("✅ File processed successfully!")
+                st.success("✅ File processed successfully!" + (" (from cache)" if cache_hit else ""))
                 
                 # Display a preview of the formatted data
                 balance_df = calculate_balances(output_df)
@@ -54,6 +63,8 @@ if st.button("Process File"):
                 with col1:
                     st.subheader("Portfolio Balances")
                     st.dataframe(balance_df)
+                    with st.expander("Balances by exchange and group"):
+                        st.dataframe(calculate_balances(output_df, by=['Exchange', 'Group']))
 
                 with col2:
                     st.subheader("Formatted Transactions (Preview)")
@@ -0,0 +1,172 @@
+# batch_formatter.py
+import argparse
+import glob
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import pandas as pd
+
+from processing_logic import process_file, detect_config, CONFIGS
+from format_cache import process_path_cached
+
+INPUT_EXTENSIONS = ('.csv', '.xlsx', '.xls')
+MANIFEST_NAME = "manifest.json"
+
+
+def collect_input_files(source):
+    """Returns the exports to format: every CSV/Excel file in a directory, or the files matching a glob."""
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
+    else:
+        paths = glob.glob(source)
+    return sorted(path for path in paths if os.path.isfile(path) and path.lower().endswith(INPUT_EXTENSIONS))
+
+
+def _output_names(paths):
+    # formatted_<name>.csv, numbered when two inputs share a file name
+    names = []
+    seen = {}
+    for path in paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        count = seen.get(stem, 0)
+        seen[stem] = count + 1
+        names.append(f"formatted_{stem}.csv" if count == 0 else f"formatted_{stem} ({count}).csv")
+    return names
+
+
+def read_export(path):
+    if path.lower().endswith(('.xlsx', '.xls')):
+        return pd.read_excel(path)
+    return pd.read_csv(path)
+
+
+def format_one_file(path, output_path, config_name=None, engine="columnar", min_confidence=0.5, cache_dir=None):
+    """
+    Formats a single export and writes it to output_path. Runs inside a worker process.
+
+    Returns the file's manifest entry; errors are recorded in the entry instead of raised
+    so one bad file does not stop the batch. With a cache_dir, files formatted before are
+    served from the format cache (rows_in is then not known).
+    """
+    entry = {
+        "input": path,
+        "output": None,
+        "config": config_name,
+        "confidence": None,
+        "rows_in": None,
+        "rows_out": None,
+        "cache_hit": False,
+        "timings": {},
+        "error": None,
+    }
+    started = time.perf_counter()
+    try:
+        if config_name is None:
+            step = time.perf_counter()
+            config_name, confidence = detect_config(path)
+            entry["timings"]["detect_seconds"] = round(time.perf_counter() - step, 4)
+            entry["config"] = config_name
+            entry["confidence"] = round(confidence, 4)
+            if config_name is None or confidence < min_confidence:
+                raise ValueError(f"Could not detect the format (best match: {config_name}, confidence {confidence:.2f}).")
+
+        if cache_dir is not None:
+            step = time.perf_counter()
+            output_df, entry["cache_hit"] = process_path_cached(path, CONFIGS[config_name], engine, cache_dir)
+            entry["timings"]["process_seconds"] = round(time.perf_counter() - step, 4)
+        else:
+            step = time.perf_counter()
+            input_df = read_export(path)
+            entry["timings"]["read_seconds"] = round(time.perf_counter() - step, 4)
+            entry["rows_in"] = len(input_df)
+
+            step = time.perf_counter()
+            output_df = process_file(input_df, CONFIGS[config_name], engine=engine)
+            entry["timings"]["process_seconds"] = round(time.perf_counter() - step, 4)
+        entry["rows_out"] = len(output_df)
+
+        step = time.perf_counter()
+        output_df.to_csv(output_path, index=False)
+        entry["timings"]["write_seconds"] = round(time.perf_counter() - step, 4)
+        entry["output"] = output_path
+    except Exception:
+        entry["error"] = traceback.format_exc()
+    entry["timings"]["total_seconds"] = round(time.perf_counter() - started, 4)
+    return entry
+
+
+def run_batch(source, output_dir, config_name=None, workers=None, engine="columnar", min_confidence=0.5, cache_dir=None):
+    """
+    Formats every export in source (a directory or glob) into output_dir.
+
+    Each file gets formatted_<name>.csv; the config is detected per file unless
+    config_name is given. Files are formatted concurrently in a process pool with
+    `workers` processes (defaults to the CPU count; 1 runs them in this process).
+    Pass cache_dir to reuse earlier results from the format cache.
+    A manifest with per-file configs, row counts, timings and errors is written to
+    output_dir/manifest.json and returned.
+    """
+    if config_name is not None and config_name not in CONFIGS:
+        raise ValueError(f"Unknown config: '{config_name}'. Expected one of {list(CONFIGS)}.")
+    paths = collect_input_files(source)
+    os.makedirs(output_dir, exist_ok=True)
+    output_paths = [os.path.join(output_dir, name) for name in _output_names(paths)]
+    workers = workers or os.cpu_count() or 1
+
+    started_at = datetime.now()
+    started = time.perf_counter()
+    entries = [None] * len(paths)
+    if workers == 1:
+        for i, (path, output_path) in enumerate(zip(paths, output_paths)):
+            entries[i] = format_one_file(path, output_path, config_name, engine, min_confidence, cache_dir)
+            print(f"Formatted {i + 1} of {len(paths)}: {os.path.basename(path)}")
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(format_one_file, path, output_path, config_name, engine, min_confidence, cache_dir): i
+                for i, (path, output_path) in enumerate(zip(paths, output_paths))
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                i = futures[future]
+                entries[i] = future.result()
+                print(f"Formatted {done} of {len(paths)}: {os.path.basename(paths[i])}")
+
+    manifest = {
+        "source": source,
+        "output_dir": output_dir,
+        "engine": engine,
+        "workers": workers,
+        "started": started_at.isoformat(timespec='seconds'),
+        "wall_seconds": round(time.perf_counter() - started, 4),
+        "files_ok": sum(entry["error"] is None for entry in entries),
+        "files_failed": sum(entry["error"] is not None for entry in entries),
+        "rows_out": sum(entry["rows_out"] or 0 for entry in entries),
+        "cache_hits": sum(entry["cache_hit"] for entry in entries),
+        "files": entries,
+    }
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Format a folder of exchange exports into the standard CSV layout.")
+    parser.add_argument("source", help="Directory of exports, or a glob such as 'exports/*.csv'")
+    parser.add_argument("output_dir", help="Where the formatted files and manifest.json are written")
+    parser.add_argument("--config", choices=list(CONFIGS), help="Use this format for every file instead of detecting it")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: CPU count)")
+    parser.add_argument("--engine", choices=["rows", "columnar"], default="columnar")
+    parser.add_argument("--cache-dir", default=None, help="Reuse formatted outputs cached in this directory")
+    args = parser.parse_args()
+
+    manifest = run_batch(args.source, args.output_dir, args.config, args.workers, args.engine,
+                         cache_dir=args.cache_dir)
+    print(f"Formatted {manifest['files_ok']} file(s), {manifest['files_failed']} failed, "
+          f"{manifest['rows_out']} rows in {manifest['wall_seconds']}s.")
+    for entry in manifest["files"]:
+        if entry["error"] is not None:
+            print(f"Failed: {entry['input']}\n{entry['error']}")
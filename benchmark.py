@@ -0,0 +1,413 @@
+# benchmark.py
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from processing_logic import process_file, CONFIGS
+from balance import calculate_balances
+from instrumentation import StageRecorder
+
+SIZES = (1_000, 10_000, 100_000, 1_000_000)
+CRYPTO = np.array(['BTC', 'ETH', 'SOL', 'ADA', 'DOT', 'XRP', 'BNB', 'MATIC', 'ATOM', 'TIA', 'SUI', 'LINK'])
+QUOTES = np.array(['USD', 'USDT', 'USDC'])
+
+
+# --- Synthetic exports: same columns and value shapes as the real files in tests/ ---
+def _timestamps(rng, n, start='2021-01-01', days=730):
+    # Sorted timestamps spread over `days`, with some trades landing on the same second
+    seconds = np.sort(rng.integers(0, days * 86400, n))
+    return pd.Timestamp(start) + pd.to_timedelta(seconds, unit='s')
+
+def _us_short_dates(times):
+    # m/d/yy HH:MM without zero padding, built by hand since strftime's '%-m' is glibc-only
+    return times.month.astype(str) + '/' + times.day.astype(str) + '/' + times.strftime('%y %H:%M')
+
+def _amounts(rng, n, scale=10.0):
+    return np.round(rng.lognormal(0, 1.5, n) * scale / 10, 8)
+
+def _ids(rng, n):
+    return np.char.add('tx', rng.integers(0, 2**62, n).astype(str))
+
+def _frame(columns, data, n):
+    # Fills the export's other columns with blanks, as pd.read_csv would
+    return pd.DataFrame({col: data[col] if col in data else np.full(n, np.nan) for col in columns})
+
+def generate_coinbase_pro(n, rng):
+    # Trades are three legs (two matches and a fee) sharing a trade id and time; the rest are transfers
+    n_trades = max(n * 9 // 30, 1)
+    n_transfers = max(n - 3 * n_trades, 0)
+    trade_times = _timestamps(rng, n_trades, '2017-10-01', 1800)
+    base = rng.choice(CRYPTO, n_trades)
+    quote = rng.choice(QUOTES, n_trades)
+    size = _amounts(rng, n_trades)
+    cost = np.round(size * rng.uniform(5, 500, n_trades), 8)
+    buying = rng.random(n_trades) < 0.6
+    trade_ids = rng.integers(1, 10**9, n_trades).astype(str)
+    legs = pd.DataFrame({
+        'type': np.repeat([['match', 'match', 'fee']], n_trades, axis=0).ravel(),
+        'time': np.repeat(trade_times, 3),
+        'amount': np.column_stack([np.where(buying, size, -size), np.where(buying, -cost, cost), -np.round(cost * 0.005, 8)]).ravel(),
+        'amount/balance unit': np.column_stack([base, quote, quote]).ravel(),
+        'trade id': np.repeat(trade_ids, 3),
+        'order id': np.repeat(_ids(rng, n_trades), 3),
+    })
+    transfers = pd.DataFrame({
+        'type': rng.choice(['deposit', 'withdrawal'], n_transfers),
+        'time': _timestamps(rng, n_transfers, '2017-10-01', 1800),
+        'amount/balance unit': rng.choice(CRYPTO, n_transfers),
+        'transfer id': _ids(rng, n_transfers),
+    })
+    transfers['amount'] = np.where(transfers['type'] == 'deposit', 1, -1) * _amounts(rng, n_transfers)
+    data = pd.concat([legs, transfers], ignore_index=True).sort_values('time', kind='stable', ignore_index=True)
+    data['time'] = data['time'].dt.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    data['portfolio'] = 'default'
+    data['balance'] = np.round(data['amount'].abs() * 3, 8)
+    columns = ['portfolio', 'type', 'time', 'amount', 'balance', 'amount/balance unit', 'transfer id', 'trade id', 'order id']
+    return _frame(columns, {col: data[col].to_numpy() for col in data.columns}, len(data))
+
+def generate_bitcoin_tax(n, rng):
+    volume = _amounts(rng, n)
+    price = rng.uniform(5, 500, n).round(2)
+    cost = (volume * price).round(2)
+    data = {
+        'Date': _timestamps(rng, n, '2018-01-01', 365).strftime('%Y-%m-%d %H:%M:%S +0000'),
+        'Action': rng.choice(['BUY', 'SELL'], n, p=[0.9, 0.1]),
+        'Symbol': rng.choice(CRYPTO, n),
+        'Account': rng.choice(['Gemini', 'Coinbase', 'Kraken'], n),
+        'Volume': volume,
+        'Price': price,
+        'Currency': 'USD',
+        'Fee': (cost * 0.0025).round(8),
+        'FeeCurrency': 'USD',
+        'Total': -cost,
+        'Cost/Proceeds': cost,
+        'ExchangeId': rng.integers(10**9, 10**10, n),
+    }
+    columns = ['Date', 'Action', 'Symbol', 'Account', 'Volume', 'Price', 'Currency', 'Fee', 'FeeCurrency', 'Total',
+               'Cost/Proceeds', 'ExchangeId', 'Category', 'Subaccount', 'Memo', 'SymbolBalance', 'CurrencyBalance', 'FeeBalance']
+    return _frame(columns, data, n)
+
+def generate_binance_us(n, rng):
+    kind = rng.choice(4, n, p=[0.7, 0.12, 0.15, 0.03])  # trade, deposit, withdrawal, convert
+    category = np.array(['Spot Trading', 'Deposit', 'Withdrawal', 'Convert'])[kind]
+    side = rng.choice(['Buy', 'Sell'], n, p=[0.85, 0.15])
+    operation = np.select([kind == 0, kind == 1, kind == 2], [side, 'Crypto Deposit', 'Crypto Withdrawal'], 'Convert')
+    traded = (kind == 0) | (kind == 3)
+    base = rng.choice(CRYPTO, n)
+    quote = rng.choice(QUOTES, n)
+    base_amount = _amounts(rng, n)
+    quote_amount = (base_amount * rng.uniform(5, 500, n)).round(8)
+    data = {
+        'User ID': 53645554,
+        'Time': _us_short_dates(_timestamps(rng, n, '2023-02-23', 365)),
+        'Category': category,
+        'Operation': operation,
+        'Order ID': _ids(rng, n),
+        'Transaction ID': rng.integers(10**9, 10**10, n),
+        'Primary Asset': np.where(traded, None, base),
+        'Realized Amount For Primary Asset': np.where(traded, np.nan, base_amount),
+        'Base Asset': np.where(traded, base, None),
+        'Realized Amount For Base Asset': np.where(traded, base_amount, np.nan),
+        'Quote Asset': np.where(traded, quote, None),
+        'Realized Amount for Quote Asset': np.where(traded, quote_amount, np.nan),
+        'Fee Asset': base,
+        'Realized Amount for Fee Asset': (base_amount * 0.001).round(8),
+    }
+    columns = ['User ID', 'Time', 'Category', 'Operation', 'Order ID', 'Transaction ID', 'Primary Asset',
+               'Realized Amount For Primary Asset', 'Realized Amount for Primary Asset in USD', 'Base Asset',
+               'Realized Amount For Base Asset', 'Realized Amount For Base Asset In USD', 'Quote Asset',
+               'Realized Amount for Quote Asset', 'Realized Amount for Quote Asset in USD', 'Fee Asset',
+               'Realized Amount for Fee Asset', 'Realized Amount for Fee Asset in USD', 'Payment Method',
+               'Withdraw Method', 'Additional Note']
+    return _frame(columns, data, n)
+
+def generate_mexc(n, rng):
+    price = rng.uniform(0.5, 500, n).round(4)
+    amount = _amounts(rng, n)
+    total = (price * amount).round(5)
+    data = {
+        'Pairs': np.char.add(np.char.add(rng.choice(CRYPTO, n), '_'), 'USDT'),
+        'Time': _timestamps(rng, n, '2023-04-09', 365).strftime('%Y-%m-%d %H:%M:%S'),
+        'Side': rng.choice(['Buy', 'Sell'], n, p=[0.7, 0.3]),
+        'Filled Price': price,
+        'Executed Amount': amount,
+        'Total': total,
+        'Fee': (total * 0.001).round(6),
+        'Role': rng.choice(['Taker', 'Maker'], n),
+    }
+    return _frame(list(data), data, n)
+
+def generate_kucoin(n, rng):
+    price = rng.uniform(0.001, 500, n)
+    amount = _amounts(rng, n, 1000)
+    volume = price * amount
+    quote = rng.choice(['USDT', 'BTC'], n, p=[0.8, 0.2])
+    data = {
+        'UID': 53235106,
+        'Account Type': 'mainAccount',
+        'Order ID': _ids(rng, n),
+        'Symbol': np.char.add(np.char.add(rng.choice(CRYPTO, n), '-'), quote),
+        'Side': rng.choice(['BUY', 'SELL'], n, p=[0.6, 0.4]),
+        'Order Type': rng.choice(['MARKET', 'LIMIT'], n),
+        'Avg. Filled Price': price,
+        'Filled Amount': amount,
+        'Filled Volume': volume,
+        'Filled Volume (USDT)': volume,
+        'Filled Time(UTC+00:00)': _timestamps(rng, n, '2021-05-01', 700).strftime('%Y-%m-%d %H:%M:%S'),
+        'Fee': volume * 0.001,
+        'Maker/Taker': rng.choice(['TAKER', 'MAKER'], n),
+        'Fee Currency': quote,
+    }
+    columns = ['UID', 'Account Type', 'Order ID', 'Symbol', 'Side', 'Order Type', 'Avg. Filled Price', 'Filled Amount',
+               'Filled Volume', 'Filled Volume (USDT)', 'Filled Time(UTC+00:00)', 'Fee', 'Tax', 'Maker/Taker', 'Fee Currency']
+    return _frame(columns, data, n)
+
+def generate_koinly(n, rng):
+    kind = rng.choice(['deposit', 'withdrawal', 'trade'], n, p=[0.4, 0.35, 0.25])
+    wallet = np.char.add(rng.choice(CRYPTO, n), ';wallet')
+    from_currency = np.char.add(rng.choice(CRYPTO, n), ';1000')
+    to_currency = np.char.add(rng.choice(CRYPTO, n), ';2000')
+    sends = kind != 'deposit'
+    receives = kind != 'withdrawal'
+    data = {
+        'ID (read-only)': _ids(rng, n),
+        'Date (UTC)': _timestamps(rng, n, '2024-01-01', 365).strftime('%Y-%m-%d %H:%M:%S'),
+        'Type': kind,
+        'From Wallet (read-only)': np.where(sends, wallet, None),
+        'From Amount': np.where(sends, _amounts(rng, n), np.nan),
+        'From Currency': np.where(sends, from_currency, None),
+        'To Wallet (read-only)': np.where(receives, wallet, None),
+        'To Amount': np.where(receives, _amounts(rng, n), np.nan),
+        'To Currency': np.where(receives, to_currency, None),
+        'Fee Amount': 0.0,
+        'Net Value (read-only)': _amounts(rng, n, 100),
+        'Value Currency (read-only)': 'USD;10',
+        'TxHash': _ids(rng, n),
+    }
+    columns = ['ID (read-only)', 'Parent ID (read-only)', 'Date (UTC)', 'Type', 'Tag', 'From Wallet (read-only)',
+               'From Wallet ID', 'From Amount', 'From Currency', 'To Wallet (read-only)', 'To Wallet ID', 'To Amount',
+               'To Currency', 'Fee Amount', 'Fee Currency', 'Net Worth Amount', 'Net Worth Currency', 'Fee Worth Amount',
+               'Fee Worth Currency', 'Net Value (read-only)', 'Fee Value (read-only)', 'Value Currency (read-only)',
+               'Deleted', 'From Source (read-only)', 'To Source (read-only)', 'Negative Balances (read-only)',
+               'Missing Rates (read-only)', 'Missing Cost Basis (read-only)', 'Synced To Accounting At (UTC read-only)',
+               'TxSrc', 'TxDest', 'TxHash', 'Description']
+    return _frame(columns, data, n)
+
+def generate_stake_tax(n, rng):
+    kind = rng.choice(['STAKING', 'TRANSFER', '_SELF_TRANSFER', 'SPEND', '_MsgDelegate', '_UNKNOWN'], n,
+                      p=[0.45, 0.25, 0.2, 0.03, 0.04, 0.03])
+    incoming = (kind == 'STAKING') | ((kind == 'TRANSFER') & (rng.random(n) < 0.5))
+    hashes = _ids(rng, n)
+    data = {
+        'timestamp': _timestamps(rng, n, '2024-04-01', 365).strftime('%Y-%m-%d %H:%M:%S'),
+        'tx_type': kind,
+        'received_amount': np.where(incoming, _amounts(rng, n), np.nan),
+        'received_currency': np.where(incoming, 'TIA', None),
+        'sent_amount': np.where(incoming, np.nan, _amounts(rng, n)),
+        'sent_currency': np.where(incoming, None, 'TIA'),
+        'fee': np.where(incoming, np.nan, 0.002),
+        'fee_currency': np.where(incoming, None, 'TIA'),
+        'txid': np.char.add(hashes, '-0'),
+        'url': np.char.add('https://www.mintscan.io/celestia/tx/', hashes),
+        'exchange': 'tia_blockchain',
+        'wallet_address': 'celestia1c425ckmve2489atttx022qpc02gxspa29wmh0d',
+    }
+    columns = ['timestamp', 'tx_type', 'received_amount', 'received_currency', 'sent_amount', 'sent_currency', 'fee',
+               'fee_currency', 'comment', 'txid', 'url', 'exchange', 'wallet_address']
+    return _frame(columns, data, n)
+
+def generate_nexo(n, rng):
+    kind = rng.choice(['Interest', 'Top up Crypto', 'Withdrawal', 'Transfer Out', 'Fixed Term Interest'], n,
+                      p=[0.85, 0.05, 0.04, 0.04, 0.02])
+    currency = rng.choice(CRYPTO, n)
+    amount = _amounts(rng, n)
+    outgoing = (kind == 'Withdrawal') | (kind == 'Transfer Out')
+    data = {
+        'Transaction': np.char.add('NXT', rng.integers(10**12, 10**13, n).astype(str)),
+        'Type': kind,
+        'Input Currency': currency,
+        'Input Amount': np.where(outgoing, -amount, amount),
+        'Output Currency': currency,
+        'Output Amount': amount,
+        'USD Equivalent': np.char.add('$', (amount * 30).round(2).astype(str)),
+        'Fee': '-',
+        'Fee Currency': '-',
+        'Details': np.char.add('approved / ', kind.astype(str)),
+        'Date / Time (UTC)': _timestamps(rng, n, '2024-04-01', 365).strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    return _frame(list(data), data, n)
+
+def generate_cointracker(n, rng):
+    kind = rng.choice(['BUY', 'STAKING_REWARD', 'TRADE', 'RECEIVE', 'SEND', 'TRANSFER', 'SELL', 'INTEREST_PAYMENT'], n,
+                      p=[0.28, 0.23, 0.17, 0.15, 0.07, 0.07, 0.02, 0.01])
+    receives = kind != 'SEND'
+    sends = np.isin(kind, ['BUY', 'TRADE', 'SEND', 'TRANSFER', 'SELL'])
+    received_currency = rng.choice(CRYPTO, n)
+    wallet = np.char.add(np.char.add('Coinbase ', received_currency), ' Wallet')
+    data = {
+        'Date': _timestamps(rng, n, '2024-08-01', 365).strftime('%m/%d/%Y %H:%M:%S'),
+        'Type': kind,
+        'Transaction ID': _ids(rng, n),
+        'Received Quantity': np.where(receives, _amounts(rng, n), np.nan),
+        'Received Currency': np.where(receives, received_currency, None),
+        'Received Wallet': np.where(receives, wallet, None),
+        'Sent Quantity': np.where(sends, _amounts(rng, n, 200), np.nan),
+        'Sent Currency': np.where(sends, np.where(kind == 'TRANSFER', received_currency, 'USD'), None),
+        'Sent Wallet': np.where(sends, np.where(kind == 'TRANSFER', wallet, 'Coinbase Cash (USD)'), None),
+        'Transaction Hash': _ids(rng, n),
+    }
+    columns = ['Date', 'Type', 'Transaction ID', 'Received Quantity', 'Received Currency', 'Received Cost Basis (USD)',
+               'Received Wallet', 'Received Address', 'Received Comment', 'Sent Quantity', 'Sent Currency',
+               'Sent Cost Basis (USD)', 'Sent Wallet', 'Sent Address', 'Sent Comment', 'Fee Amount', 'Fee Currency',
+               'Fee Cost Basis (USD)', 'Realized Return (USD)', 'Fee Realized Return (USD)', 'Transaction Hash']
+    return _frame(columns, data, n)
+
+GENERATORS = {
+    "Coinbase Pro": generate_coinbase_pro,
+    "Bitcoin.tax": generate_bitcoin_tax,
+    "Binance US": generate_binance_us,
+    "MEXC": generate_mexc,
+    "KuCoin": generate_kucoin,
+    "Koinly": generate_koinly,
+    "Stake Tax": generate_stake_tax,
+    "Nexo": generate_nexo,
+    "CoinTracker": generate_cointracker,
+}
+
+
+# --- Timing ---
+def _measure(func, *args, measure_memory=True, **kwargs):
+    # Wall time of one call, then peak traced memory of a second call (tracing slows the call down)
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - started
+    peak_mb = None
+    if measure_memory:
+        tracemalloc.start()
+        func(*args, **kwargs)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result, seconds, peak_mb
+
+def run_benchmarks(sizes=SIZES, platforms=None, engine="columnar", seed=0, measure_memory=True, output=None):
+    """
+    Times process_file and calculate_balances on synthetic exports for every platform and size.
+
+    Returns the results and, if output is given, writes them there as JSON so two runs
+    can be compared with compare_runs.
+    """
+    platforms = platforms or list(GENERATORS)
+    results = []
+    for platform_name in platforms:
+        config = CONFIGS[platform_name]
+        for size in sizes:
+            input_df = GENERATORS[platform_name](size, np.random.default_rng(seed))
+            output_df, process_seconds, process_peak = _measure(process_file, input_df, config, engine=engine,
+                                                                measure_memory=measure_memory)
+            _, balance_seconds, balance_peak = _measure(calculate_balances, output_df, measure_memory=measure_memory)
+            results.append({
+                "platform": platform_name,
+                "rows_in": len(input_df),
+                "rows_out": len(output_df),
+                "process_seconds": round(process_seconds, 4),
+                "process_peak_mb": None if process_peak is None else round(process_peak, 1),
+                "balances_seconds": round(balance_seconds, 4),
+                "balances_peak_mb": None if balance_peak is None else round(balance_peak, 1),
+            })
+            print(f"{platform_name:<13} {len(input_df):>9} rows: process_file {process_seconds:8.3f}s, "
+                  f"calculate_balances {balance_seconds:8.3f}s")
+
+    run = {
+        "started": datetime.now().isoformat(timespec='seconds'),
+        "engine": engine,
+        "seed": seed,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "results": results,
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(run, f, indent=2)
+    return run
+
+def _stage_peaks(input_df, config, engine):
+    recorder = StageRecorder()
+    process_file(input_df, config, engine=engine, recorder=recorder)
+    return [(record["stage"], record["peak_mb"]) for record in recorder.stages]
+
+def check_concurrent_peaks(platform_name, size, threads=4, engine="columnar", seed=0, min_mb=1.0):
+    """
+    Runs process_file with a StageRecorder once on its own and then in `threads` threads
+    at once, and returns each stage's serial peak_mb next to the lowest and highest
+    peak_mb the concurrent runs recorded.
+
+    Runs that overlap share tracemalloc, so a stage's peak also counts the other runs'
+    memory and should come out at least as high as in the serial run. A stage that comes
+    out well below it (ok is False) lost its peak to another run. Memory the other runs
+    free meanwhile can pull a stage below its serial peak too, which only shows in stages
+    that allocate little, so stages with a serial peak under min_mb aren't checked (ok is None).
+    """
+    config = CONFIGS[platform_name]
+    input_df = GENERATORS[platform_name](size, np.random.default_rng(seed))
+    _stage_peaks(input_df, config, engine)  # warm up imports and caches before the serial run
+    serial = _stage_peaks(input_df, config, engine)
+    with ThreadPoolExecutor(threads) as pool:
+        concurrent = list(pool.map(lambda _: _stage_peaks(input_df, config, engine), range(threads)))
+
+    rows = []
+    for index, (stage_name, serial_peak) in enumerate(serial):
+        peaks = [run[index][1] for run in concurrent]
+        rows.append({
+            "stage": stage_name,
+            "serial_peak_mb": round(serial_peak, 2),
+            "concurrent_min_mb": round(min(peaks), 2),
+            "concurrent_max_mb": round(max(peaks), 2),
+            # Allow for the odd allocation that differs from run to run
+            "ok": min(peaks) >= serial_peak * 0.9 if serial_peak >= min_mb else None,
+        })
+    return pd.DataFrame(rows)
+
+def compare_runs(baseline_path, current_path):
+    """Returns a table of current vs baseline timings, matched on platform and input size (ratio < 1 is faster)."""
+    with open(baseline_path) as f:
+        baseline = pd.DataFrame(json.load(f)["results"])
+    with open(current_path) as f:
+        current = pd.DataFrame(json.load(f)["results"])
+    merged = current.merge(baseline, on=["platform", "rows_in"], suffixes=("", "_baseline"))
+    for stage in ("process", "balances"):
+        merged[f"{stage}_ratio"] = (merged[f"{stage}_seconds"] / merged[f"{stage}_seconds_baseline"]).round(3)
+    return merged[["platform", "rows_in", "process_seconds_baseline", "process_seconds", "process_ratio",
+                   "balances_seconds_baseline", "balances_seconds", "balances_ratio"]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark process_file and calculate_balances on synthetic exports.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--platforms", nargs="+", choices=list(GENERATORS), default=None)
+    parser.add_argument("--engine", choices=["rows", "columnar"], default="columnar")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="Skip the traced second run used for peak memory")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None, help="Earlier results JSON to compare this run against")
+    parser.add_argument("--check-threads", type=int, default=None, metavar="N",
+                        help="Instead of benchmarking, check stage peak_mb of N concurrent runs against a serial run")
+    args = parser.parse_args()
+
+    if args.check_threads:
+        for platform_name in args.platforms or list(GENERATORS):
+            for size in args.sizes:
+                check = check_concurrent_peaks(platform_name, size, args.check_threads, args.engine, args.seed)
+                print(f"{platform_name} ({size} rows, {args.check_threads} threads):")
+                print(check.to_string(index=False))
+    else:
+        run_benchmarks(args.sizes, args.platforms, args.engine, args.seed, not args.no_memory, args.output)
+        if args.compare:
+            print(compare_runs(args.compare, args.output).to_string(index=False))
@@ -0,0 +1,132 @@
+# format_cache.py
+import hashlib
+import io
+import json
+import os
+import pickle
+
+import pandas as pd
+
+import processing_logic
+from processing_logic import process_file, resolve_config
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "FORMAT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "crypto_formatter")
+)
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+try:
+    import pyarrow  # noqa: F401 -- needed for Parquet
+    CACHE_EXTENSION = ".parquet"
+except ImportError:
+    # Without pyarrow the cache still works, stored as pickles
+    CACHE_EXTENSION = ".pkl"
+
+_version_stamp = None
+
+
+def processing_logic_version():
+    """Hash of processing_logic.py, so any change to the formatting code invalidates the cache."""
+    global _version_stamp
+    if _version_stamp is None:
+        with open(processing_logic.__file__, 'rb') as f:
+            _version_stamp = hashlib.sha256(f.read()).hexdigest()
+    return _version_stamp
+
+
+def cache_key(input_bytes, config=None, engine="rows"):
+    """Content hash of the input file, the config contents and the processing_logic version."""
+    digest = hashlib.sha256()
+    digest.update(input_bytes)
+    digest.update(json.dumps(config, sort_keys=True, default=str).encode('utf-8'))
+    digest.update(engine.encode('utf-8'))
+    digest.update(processing_logic_version().encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _cache_path(key, cache_dir):
+    return os.path.join(cache_dir, key + CACHE_EXTENSION)
+
+
+def load_cached(key, cache_dir=DEFAULT_CACHE_DIR):
+    """Returns the cached DataFrame for key, or None. A hit marks the entry as recently used."""
+    path = _cache_path(key, cache_dir)
+    try:
+        if CACHE_EXTENSION == ".parquet":
+            df = pd.read_parquet(path)
+        else:
+            with open(path, 'rb') as f:
+                df = pickle.load(f)
+        os.utime(path)
+    except (FileNotFoundError, OSError, pickle.UnpicklingError, EOFError):
+        return None
+    return df
+
+
+def store_cached(key, df, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    """Writes df under key, then evicts least recently used entries until the cache fits in max_bytes."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_path(key, cache_dir)
+    # Write to a temporary name first so a parallel reader never sees half a file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if CACHE_EXTENSION == ".parquet":
+        df.to_parquet(tmp_path, index=False)
+    else:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    evict(cache_dir, max_bytes)
+
+
+def evict(cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    """Deletes the least recently used entries until the cache is at most max_bytes."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(CACHE_EXTENSION):
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def read_input_bytes(input_bytes, file_name=""):
+    if file_name.lower().endswith(('.xlsx', '.xls')):
+        return pd.read_excel(io.BytesIO(input_bytes))
+    return pd.read_csv(io.BytesIO(input_bytes))
+
+
+def process_bytes_cached(input_bytes, config=None, engine="rows", file_name="",
+                         cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    process_file for raw file contents, with the result cached on disk.
+
+    Returns (output_df, cache_hit). With config=None the format is detected, and the
+    detection is part of what gets cached.
+    """
+    key = cache_key(input_bytes, config, engine)
+    cached = load_cached(key, cache_dir)
+    if cached is not None:
+        return cached, True
+
+    input_df = read_input_bytes(input_bytes, file_name)
+    output_df = process_file(input_df, resolve_config(input_df, config), engine=engine)
+    store_cached(key, output_df, cache_dir, max_bytes)
+    return output_df, False
+
+
+def process_path_cached(path, config=None, engine="rows", cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    with open(path, 'rb') as f:
+        input_bytes = f.read()
+    return process_bytes_cached(input_bytes, config, engine, os.path.basename(path), cache_dir, max_bytes)
@@ -0,0 +1,283 @@
+# instrumentation.py
+import contextvars
+import cProfile
+import io
+import json
+import logging
+import os
+import platform
+import re
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+import pandas as pd
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_active_recorder = contextvars.ContextVar("stage_recorder", default=None)
+_active_logger = contextvars.ContextVar("run_logger", default=None)
+
+
+class _MemoryTracer:
+    # tracemalloc is process-wide, so every recorder shares this one owner. It starts
+    # tracing for the first measured stage, stops it after the last one (unless it was
+    # already tracing before), and folds the peak into the open stages of all recorders,
+    # so one recorder's reset_peak doesn't lose a peak another recorder's stage saw.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open = []
+        self._started_tracing = False
+
+    def open(self, record):
+        with self._lock:
+            if not self._open and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            self._fold_peak()
+            record["_start_bytes"] = record["_peak_bytes"] = tracemalloc.get_traced_memory()[0]
+            self._open.append(record)
+
+    def close(self, record):
+        with self._lock:
+            self._fold_peak()
+            # Records are dicts, so find this one by identity rather than by value
+            del self._open[next(i for i, open_record in enumerate(self._open) if open_record is record)]
+            if not self._open and self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+        return (record.pop("_peak_bytes") - record.pop("_start_bytes")) / 2**20
+
+    def _fold_peak(self):
+        # Credit the peak since the last reset to every open stage, then start a new peak.
+        # This keeps each stage's peak right when stages are nested or overlap.
+        peak = tracemalloc.get_traced_memory()[1]
+        for record in self._open:
+            record["_peak_bytes"] = max(record["_peak_bytes"], peak)
+        tracemalloc.reset_peak()
+
+
+_memory_tracer = _MemoryTracer()
+
+
+def _row_count(rows):
+    if rows is None or isinstance(rows, int):
+        return rows
+    return len(rows)
+
+
+class StageRecorder:
+    """
+    Records wall time, row counts and peak memory of the named stages of a pipeline run.
+
+    Activate one with recording(recorder) (or pass it to WBW.main / process_file), and
+    the pipelines report their stages into it. Each stage is a dict with its name,
+    depth (how many stages it runs inside; a stage's time includes its nested stages),
+    rows_in/rows_out, seconds, peak_mb and profile (the stage's pstats file).
+
+    peak_mb is how far the memory traced by tracemalloc rose above its level at the
+    start of the stage. tracemalloc traces the whole process, not one run: while the
+    stage runs, allocations made by other threads (e.g. other runs in a server) count
+    towards it too, so it is only the stage's own peak when nothing else runs alongside.
+    Recorders that measure at the same time share one tracing session, and tracing
+    stops when the last measured stage in the process ends.
+
+    tracemalloc slows Python code down by a good factor, so compare seconds between
+    runs with the same measure_memory setting. With profile_dir set, each stage is run
+    under cProfile and dumped to <profile_dir>/<index>_<stage>.prof; a stage inside a
+    profiled stage is covered by its parent's profile.
+    """
+
+    def __init__(self, measure_memory=True, profile_dir=None):
+        self.measure_memory = measure_memory
+        self.profile_dir = profile_dir
+        self.stages = []
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self._open = []
+        self._profiling = False
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """Times the block as stage `name`. Set rows_out on the yielded record to record the rows it produced."""
+        record = {"stage": name, "depth": len(self._open), "rows_in": _row_count(rows_in), "rows_out": None,
+                  "seconds": None, "peak_mb": None, "profile": None}
+        self.stages.append(record)
+        index = len(self.stages)
+
+        if self.measure_memory:
+            _memory_tracer.open(record)
+        profiler = self._start_profile()
+        self._open.append(record)
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - started
+            self._open.pop()
+            if profiler is not None:
+                record["profile"] = self._dump_profile(profiler, index, name)
+            record["rows_out"] = _row_count(record["rows_out"])
+            if self.measure_memory:
+                record["peak_mb"] = _memory_tracer.close(record)
+
+    def _start_profile(self):
+        if self.profile_dir is None or self._profiling:
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running (e.g. the whole script is under cProfile)
+            return None
+        self._profiling = True
+        return profiler
+
+    def _dump_profile(self, profiler, index, name):
+        profiler.disable()
+        self._profiling = False
+        os.makedirs(self.profile_dir, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_').lower()
+        path = os.path.join(self.profile_dir, f"{index:02d}_{slug}.prof")
+        profiler.dump_stats(path)
+        return path
+
+    def to_dict(self):
+        return {
+            "started": self.started,
+            "python": platform.python_version(),
+            "measure_memory": self.measure_memory,
+            "stages": [{k: v for k, v in record.items() if not k.startswith('_')} for record in self.stages],
+        }
+
+    def to_json(self, path=None):
+        """The stages as JSON, also written to path if given."""
+        text = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+
+@contextmanager
+def recording(recorder):
+    """Makes recorder the one stage() reports to inside the block. recording(None) changes nothing."""
+    if recorder is None:
+        yield None
+        return
+    token = _active_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _active_recorder.reset(token)
+
+
+def stage(name, rows_in=None):
+    """
+    Times the block as stage `name` in the active recorder, if there is one.
+
+    Yields a record dict either way, so callers can always set record["rows_out"].
+    Without an active recorder this costs a context variable lookup.
+    """
+    recorder = _active_recorder.get()
+    if recorder is None:
+        return nullcontext({})
+    return recorder.stage(name, rows_in)
+
+
+# --- Per-run logging: each run logs to a logger of its own instead of the root logger ---
+class FrameFormatter(logging.Formatter):
+    """
+    Formats DataFrames and Series in log messages with float_format, so log output
+    doesn't depend on pandas' process-wide display options. Frames are only turned
+    into text when a record is actually emitted.
+    """
+
+    def __init__(self, fmt=LOG_FORMAT, float_format='{:.8f}'.format):
+        super().__init__(fmt)
+        self.float_format = float_format
+
+    def _text(self, value):
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            return value.to_string(float_format=self.float_format)
+        return value
+
+    def format(self, record):
+        args = record.args if isinstance(record.args, tuple) else ()
+        if isinstance(record.msg, (pd.DataFrame, pd.Series)) or any(isinstance(arg, (pd.DataFrame, pd.Series)) for arg in args):
+            # Other handlers get the same record, so format a copy
+            record = logging.makeLogRecord(record.__dict__)
+            record.msg = self._text(record.msg)
+            record.args = tuple(self._text(arg) for arg in args) or None
+        return super().format(record)
+
+
+def run_logger(name, stream=None, level=logging.DEBUG, float_format='{:.8f}'.format):
+    """
+    A new logger for one run. It keeps its output in memory (see log_text) and also
+    writes it to stream if given.
+
+    The logger isn't registered with logging.getLogger, so it doesn't reach the root
+    logger's handlers and is freed with the run.
+    """
+    logger = logging.Logger(name, level)
+    for target in [io.StringIO()] + ([stream] if stream is not None else []):
+        handler = logging.StreamHandler(target)
+        handler.setFormatter(FrameFormatter(float_format=float_format))
+        logger.addHandler(handler)
+    return logger
+
+
+def log_text(logger):
+    """Everything a run_logger() has logged so far."""
+    return logger.handlers[0].stream.getvalue()
+
+
+class _RecordCollector(logging.Handler):
+    # Keeps records with their message already rendered, so they can be pickled back
+    # from a worker process and handled by the run's logger there
+    def __init__(self, float_format):
+        super().__init__()
+        self.setFormatter(FrameFormatter('%(message)s', float_format))
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(logging.makeLogRecord(
+            {**record.__dict__, 'msg': self.format(record), 'args': None, 'exc_info': None, 'exc_text': None}
+        ))
+
+
+def collecting_logger(name, level=logging.DEBUG, float_format='{:.8f}'.format):
+    """A logger that keeps its records; replay them with replay_records()."""
+    logger = logging.Logger(name, level)
+    logger.addHandler(_RecordCollector(float_format))
+    return logger
+
+
+def collected_records(logger):
+    return logger.handlers[0].records
+
+
+def replay_records(logger, records):
+    """Emits records collected elsewhere (e.g. in a worker process) through logger's handlers."""
+    for record in records:
+        logger.handle(record)
+
+
+def current_logger(default):
+    """The logger of the run in progress (see logging_to), or default outside a run."""
+    return _active_logger.get() or default
+
+
+@contextmanager
+def logging_to(logger):
+    """Makes logger the one current_logger() returns inside the block. logging_to(None) changes nothing."""
+    if logger is None:
+        yield None
+        return
+    token = _active_logger.set(logger)
+    try:
+        yield logger
+    finally:
+        _active_logger.reset(token)
@@ -1,8 +1,17 @@
 # processing_logic.py
 # Imports
+import csv
+import heapq
+import logging
+import os
+import pickle
+import tempfile
 import pandas as pd
 import numpy as np 
 from datetime import datetime
+from pandas.tseries.api import guess_datetime_format
+
+from instrumentation import recording, stage
 #import matplotlib.pyplot as plt
 #import io
 
@@ -240,17 +249,103 @@ def extract_datetime_combined(dt_str):
         print(f"Error formatting datetime '{dt_str}': {e}")
         return ''    
 
+# --- Bulk date stage: parse a whole column once, format once at the end ---
+OUTPUT_DATETIME_FORMAT = '%d-%m-%Y %H:%M:%S'
+
+def _wall_time(value):
+    # The wall-clock time extract_datetime_combined would print, to the second
+    dt_obj = pd.to_datetime(value, errors='coerce')
+    if pd.isna(dt_obj):
+        return pd.NaT
+    if dt_obj.tzinfo is not None:
+        dt_obj = dt_obj.tz_localize(None)
+    return dt_obj.floor('s')
+
+def _bulk_wall_times(values, datetime_format):
+    parsed = pd.to_datetime(pd.Index(values, dtype=object), format=datetime_format, errors='coerce')
+    if not isinstance(parsed, pd.DatetimeIndex):
+        raise ValueError("Values do not share a single time zone.")
+    if parsed.tz is not None:
+        parsed = parsed.tz_localize(None)
+    return parsed.floor('s').as_unit('ns')
+
+def infer_datetime_format(dt_series, sample_size=50):
+    """
+    Guesses the strftime format of a datetime column from a sample of its values.
+
+    Returns None when no single format reads the whole sample the same way
+    pd.to_datetime does, or when the format is day-first (ambiguous dates like
+    05/12/2021 parse month-first one value at a time, so day-first can't be trusted).
+    """
+    sample = pd.Series(dt_series.dropna().unique()[:sample_size], dtype=object)
+    sample = sample[sample.map(lambda value: isinstance(value, str) and value.strip() != '')]
+    if sample.empty:
+        return None
+    guesses = sample.map(guess_datetime_format).dropna()
+    if guesses.empty:
+        return None
+    datetime_format = guesses.mode().iloc[0]
+    if '%d' in datetime_format and '%m' in datetime_format and datetime_format.index('%d') < datetime_format.index('%m'):
+        return None
+    try:
+        bulk = _bulk_wall_times(sample.to_numpy(), datetime_format)
+    except (ValueError, TypeError):
+        return None
+    expected = pd.DatetimeIndex([_wall_time(value) for value in sample]).as_unit('ns')
+    if not bulk.equals(expected):
+        return None
+    return datetime_format
+
+def parse_datetime_column(dt_series, datetime_format=None, cache=None):
+    """
+    Parses a datetime column in bulk into naive wall-clock times, floored to the second.
+
+    The input format is inferred from a sample when datetime_format is not given. Each
+    distinct value is parsed once; pass the same cache dict across calls to reuse parses
+    between stages or chunks of one file. Values the format can't read fall back to
+    pd.to_datetime one at a time, exactly like extract_datetime_combined.
+    """
+    if pd.api.types.is_datetime64_any_dtype(dt_series):
+        wall = dt_series.dt.tz_localize(None) if dt_series.dt.tz is not None else dt_series
+        return wall.dt.floor('s').astype('datetime64[ns]')
+    if cache is None:
+        cache = {}
+    if datetime_format is None:
+        datetime_format = infer_datetime_format(dt_series)
+
+    codes, uniques = pd.factorize(dt_series)
+    uniques = np.asarray(uniques, dtype=object)
+    missing = [value for value in uniques if value not in cache]
+    if missing:
+        parsed = pd.DatetimeIndex([pd.NaT] * len(missing)).as_unit('ns')
+        texts = [value for value in missing if isinstance(value, str)]
+        if datetime_format is not None and texts:
+            try:
+                bulk = dict(zip(texts, _bulk_wall_times(texts, datetime_format)))
+                parsed = pd.DatetimeIndex([bulk.get(value, pd.NaT) for value in missing]).as_unit('ns')
+            except (ValueError, TypeError):
+                pass
+        for value, wall in zip(missing, parsed):
+            if pd.isna(wall) and not (isinstance(value, str) and value == ''):
+                wall = _wall_time(value)
+            cache[value] = wall
+    wall_times = pd.DatetimeIndex([cache[value] for value in uniques] + [pd.NaT]).as_unit('ns').to_numpy()
+    return pd.Series(wall_times[codes], index=dt_series.index)
+
+def format_datetime_values(wall_times):
+    return wall_times.dt.strftime(OUTPUT_DATETIME_FORMAT).astype(object).fillna('')
+
+LEG_TYPES = {
+    'deposit': 'Deposit',
+    'withdrawal': 'Withdrawal',
+    'match': 'Trade_Leg',
+    'fee': 'Fee_Leg',
+    'conversion': 'Swap_Leg',
+}
+
 def map_transaction_type(raw_type):
-    if raw_type == 'deposit':
-        return 'Deposit'
-    elif raw_type == 'withdrawal':
-        return 'Withdrawal'
-    elif raw_type == 'match':
-        return 'Trade_Leg'
-    elif raw_type == 'fee':
-        return 'Fee_Leg'
-    elif raw_type == 'conversion':
-        return 'Swap_Leg'
+    if isinstance(raw_type, str) and raw_type in LEG_TYPES:
+        return LEG_TYPES[raw_type]
     return 'Other'
 
 def get_buy_amount_from_leg(raw_type, amount_raw):
@@ -284,6 +379,55 @@ transformation_actions = {
     "passthrough": passthrough,
 }
 
+# --- Vectorized versions: take the source column(s) as Series and return a Series ---
+def format_datetime_column(dt_series, datetime_format=None, cache=None):
+    # extract_datetime_combined for a whole column
+    return format_datetime_values(parse_datetime_column(dt_series, datetime_format, cache))
+
+def map_transaction_type_column(raw_type):
+    return raw_type.map(LEG_TYPES).fillna('Other')
+
+def _leg_amount_column(raw_type, amount_raw, matches):
+    amount = pd.to_numeric(amount_raw, errors='coerce').astype(float)
+    return pd.Series(np.where(matches(raw_type, amount), amount.abs(), 0.0), index=amount.index)
+
+def get_buy_amount_from_leg_column(raw_type, amount_raw):
+    return _leg_amount_column(raw_type, amount_raw, lambda raw_type, amount: (
+        (raw_type == 'deposit') | (raw_type.isin(['match', 'conversion']) & (amount > 0))))
+
+def get_sell_amount_from_leg_column(raw_type, amount_raw):
+    return _leg_amount_column(raw_type, amount_raw, lambda raw_type, amount: (
+        (raw_type == 'withdrawal') | (raw_type.isin(['match', 'conversion']) & (amount < 0))))
+
+def get_fee_amount_from_leg_column(raw_type, amount_raw):
+    return _leg_amount_column(raw_type, amount_raw, lambda raw_type, amount: raw_type == 'fee')
+
+def passthrough_column(values):
+    return values.copy()
+
+# Actions listed here run as one column operation; any other action in
+# transformation_actions falls back to calling the scalar helper row by row.
+vectorized_transformation_actions = {
+    "extract_datetime_combined": format_datetime_column,
+    "map_transaction_type": map_transaction_type_column,
+    "get_buy_amount_from_leg": get_buy_amount_from_leg_column,
+    "get_sell_amount_from_leg": get_sell_amount_from_leg_column,
+    "get_fee_amount_from_leg": get_fee_amount_from_leg_column,
+    "passthrough": passthrough_column,
+}
+
+def apply_transformation(renamed_df, action, source_cols):
+    """
+    Runs a transformation action over the source column(s) of renamed_df.
+    """
+    if isinstance(source_cols, str):
+        source_cols = [source_cols]
+    if action in vectorized_transformation_actions:
+        return vectorized_transformation_actions[action](*[renamed_df[col] for col in source_cols])
+    return renamed_df.apply(
+        lambda row: transformation_actions[action](*[row.get(col) for col in source_cols]), axis=1
+    )
+
 # --- 4. Function for Trade Consolidation (Updated Currency Logic) ---
 def consolidate_trade_rows(intermediate_df, config):
     final_rows = []
@@ -432,11 +576,11 @@ def consolidate_trade_rows(intermediate_df, config):
             if buy_currency.lower()==("w" + sell_currency.lower()) or sell_currency.lower()==("w" + buy_currency.lower()):
                 consolidated_row2['Type'] = 'Swap (non taxable)' # Final type is 'Swap (non taxable)'
                 base_comment = "Swap (non taxable)"
-                print("DEBUG Swap (non taxable) found")
+                logging.debug("Swap (non taxable) found")
             else:
                 consolidated_row2['Type'] = 'Trade'
                 base_comment = "Trade"
-                print("DEBUG trade found")
+                logging.debug("Trade found")
 
             comment_parts = []
             if total_buy > 0 and consolidated_row2['Cur.']:
@@ -459,33 +603,196 @@ def consolidate_trade_rows(intermediate_df, config):
         if col in final_df.columns:
             final_df[col] = pd.to_numeric(final_df[col], errors='coerce').fillna(0)
 
-    print("DEBUG Dates")
-    print(final_df['Date'])        
-            
-    # Create a temporary datetime column for robust sorting
-    final_df['Sort_DateTime'] = pd.to_datetime(final_df['Date'], format='%d-%m-%Y %H:%M:%S', errors='coerce')
-    final_df = final_df.sort_values(by='Sort_DateTime').drop(columns=['Sort_DateTime'])
+    # The Series is only formatted when debug logging is on
+    logging.debug("Dates before sorting:\n%s", final_df['Date'])
+
+    with stage("sort", final_df) as record:
+        final_df = sort_consolidated_df(final_df)
+        record["rows_out"] = final_df
+
+    logging.debug("Dates after sorting:\n%s", final_df['Date'])
+
+    return final_df
+
+def sort_consolidated_df(final_df):
+    # Create a temporary datetime column for robust sorting, unless the caller already parsed one
+    if 'Sort_DateTime' not in final_df.columns:
+        final_df['Sort_DateTime'] = pd.to_datetime(final_df['Date'], format=OUTPUT_DATETIME_FORMAT, errors='coerce')
+    final_df = final_df.sort_values(by='Sort_DateTime', kind='stable').drop(columns=['Sort_DateTime'])
 
     # Explicitly cast the 'Date' column to string to prevent re-formatting by to_csv
     final_df['Date'] = final_df['Date'].astype(str)
+    return final_df
+
+# --- 4b. Grouped Trade Consolidation: same output as consolidate_trade_rows in one aggregation pass ---
+def _group_sums(values, codes, ngroups):
+    """
+    Per-group sums added in the same order as Series.sum (sequential below 8 legs,
+    numpy's own sum above), so totals match the group-by-group loop to the last bit.
+    NaN values are skipped, as Series.sum does.
+    """
+    values = np.nan_to_num(values)
+    sizes = np.bincount(codes, minlength=ngroups)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(int)
+    sorted_values = values[np.argsort(codes, kind='stable')]
+    totals = np.zeros(ngroups)
+    small = sizes < 8
+    for k in range(7):
+        take = small & (sizes > k)
+        totals[take] += sorted_values[starts[take] + k]
+    for group in np.flatnonzero(~small):
+        totals[group] = sorted_values[starts[group]:starts[group] + sizes[group]].sum()
+    return totals
+
+def _aggregate_legs(legs_df, keys, amount_cols):
+    """
+    Sums each amount column per group and picks the currency of the first leg
+    that contributed to it, using a masked idxmax over the group's rows.
+    """
+    legs_df = legs_df.reset_index(drop=True)
+    legs_df['_position'] = np.arange(len(legs_df))
+    named_aggs = {'first_position': ('_position', 'min')}
+    for col in amount_cols:
+        legs_df[f'_{col}_leg'] = legs_df[col] > 0
+        named_aggs[f'{col}_position'] = (f'_{col}_leg', 'idxmax')
+    grouper = legs_df.groupby(keys, dropna=False)
+    grouped = grouper.agg(**named_aggs)
+    codes = grouper.ngroup().to_numpy()
+
+    currencies = legs_df['Currency_Raw'].to_numpy(dtype=object)
+    first_position = grouped['first_position'].to_numpy()
+    result = pd.DataFrame({
+        'Exchange': legs_df['Exchange'].to_numpy(dtype=object)[first_position],
+        'Group': legs_df['Group'].to_numpy(dtype=object)[first_position],
+    })
+    for col in amount_cols:
+        total = _group_sums(legs_df[col].to_numpy(dtype=float), codes, len(grouped))
+        has_total = total > 0
+        result[f'total_{col}'] = total
+        result[col] = np.where(has_total, total, np.nan)
+        result[f'{col}_currency'] = np.where(has_total, currencies[grouped[f'{col}_position'].to_numpy()], '')
+    return grouped.index.to_frame(index=False), result
+
+def _comment_part(label, total, currency):
+    # f"{label} {total:.8f} {currency}" where the amount and its currency are both present
+    has_part = (total > 0) & (currency != '')
+    text = label + ' ' + pd.Series(np.char.mod('%.8f', total)) + ' ' + currency.astype(str).fillna('nan')
+    return text.where(has_part, '')
+
+def _join_comment(base_comment, parts):
+    # f"{base_comment}: {', '.join(comment_parts)}", or just base_comment when there are no parts
+    joined = parts[0]
+    for part in parts[1:]:
+        joined = joined.where(part == '', joined.where(joined == '', joined + ', ') + part)
+    return base_comment.where(joined == '', base_comment + ': ' + joined)
+
+def consolidate_trade_rows_grouped(intermediate_df, config):
+    target_columns = config["target_columns"]
+    frames = []
+
+    # Parse every timestamp once; the groups below reuse the cached parses
+    datetime_format = infer_datetime_format(intermediate_df['DateTime_Raw'])
+    date_cache = {}
+    def dated(rows, dt_series):
+        wall_times = parse_datetime_column(dt_series, datetime_format, date_cache)
+        rows['Date'] = format_datetime_values(wall_times).to_numpy()
+        rows['Sort_DateTime'] = wall_times.to_numpy()
+
+    # Deposits and withdrawals pass straight through, one row each
+    transfers = intermediate_df[intermediate_df['Type_Intermediate'].isin(['Deposit', 'Withdrawal'])].reset_index(drop=True)
+    if not transfers.empty:
+        is_deposit = transfers['Type_Intermediate'] == 'Deposit'
+        transfer_rows = pd.DataFrame('', index=transfers.index, columns=target_columns, dtype=object)
+        transfer_rows['Type'] = transfers['Type_Intermediate']
+        dated(transfer_rows, transfers['DateTime_Raw'])
+        transfer_rows['Exchange'] = transfers['Exchange']
+        transfer_rows['Group'] = transfers['Group']
+        transfer_rows['Buy'] = transfers['Buy'].astype(object).where(is_deposit, '')
+        transfer_rows['Cur.'] = transfers['Currency_Raw'].astype(object).where(is_deposit, '')
+        transfer_rows['Sell'] = transfers['Sell'].astype(object).where(~is_deposit, '')
+        transfer_rows['Cur..1'] = transfers['Currency_Raw'].astype(object).where(~is_deposit, '')
+        transfer_rows['Comment'] = (transfers['Type_Intermediate'] + ' (Transfer ID: '
+                                    + transfers['Transfer_ID_Raw'].astype(str).fillna('nan') + ')')
+        frames.append(transfer_rows)
+
+    # Trade and fee legs: one row per (Trade ID, time)
+    trade_legs = intermediate_df[intermediate_df['Type_Intermediate'].isin(['Trade_Leg', 'Fee_Leg'])]
+    if not trade_legs.empty:
+        keys, trades = _aggregate_legs(trade_legs, ['Trade_ID_Raw', 'DateTime_Raw'], ['Buy', 'Sell', 'Fee'])
+        trade_rows = pd.DataFrame('', index=trades.index, columns=target_columns, dtype=object)
+        trade_rows['Type'] = 'Trade'
+        dated(trade_rows, keys['DateTime_Raw'])
+        for col, currency_col in [('Buy', 'Cur.'), ('Sell', 'Cur..1'), ('Fee', 'Cur..2')]:
+            trade_rows[col] = trades[col]
+            trade_rows[currency_col] = trades[f'{col}_currency']
+        trade_rows['Exchange'] = trades['Exchange']
+        trade_rows['Group'] = trades['Group']
+        trade_id = keys['Trade_ID_Raw']
+        base_comment = ('Trade (Trade ID: ' + trade_id.astype(str).fillna('nan') + ')').where(trade_id.notna(), 'Trade')
+        trade_rows['Comment'] = _join_comment(base_comment, [
+            _comment_part('Buy', trades['total_Buy'], trades['Buy_currency']),
+            _comment_part('Sell', trades['total_Sell'], trades['Sell_currency']),
+            _comment_part('Fee', trades['total_Fee'], trades['Fee_currency']),
+        ])
+        frames.append(trade_rows)
+
+    # Conversion legs: one row per time, with no fee
+    swap_legs = intermediate_df[intermediate_df['Type_Intermediate'] == 'Swap_Leg']
+    if not swap_legs.empty:
+        keys, swaps = _aggregate_legs(swap_legs, ['DateTime_Raw'], ['Buy', 'Sell'])
+        swap_rows = pd.DataFrame('', index=swaps.index, columns=target_columns, dtype=object)
+        buy_currency = swaps['Buy_currency'].astype(str).str.lower()
+        sell_currency = swaps['Sell_currency'].astype(str).str.lower()
+        wrapped = (buy_currency == 'w' + sell_currency) | (sell_currency == 'w' + buy_currency)
+        base_comment = pd.Series(np.where(wrapped, 'Swap (non taxable)', 'Trade'), index=swaps.index)
+        swap_rows['Type'] = base_comment
+        dated(swap_rows, keys['DateTime_Raw'])
+        swap_rows['Buy'] = swaps['Buy']
+        swap_rows['Cur.'] = swaps['Buy_currency']
+        swap_rows['Sell'] = swaps['Sell']
+        swap_rows['Cur..1'] = swaps['Sell_currency']
+        swap_rows['Fee'] = 0.0
+        swap_rows['Exchange'] = swaps['Exchange']
+        swap_rows['Group'] = swaps['Group']
+        swap_rows['Comment'] = _join_comment(base_comment, [
+            _comment_part('Buy', swaps['total_Buy'], swaps['Buy_currency']),
+            _comment_part('Sell', swaps['total_Sell'], swaps['Sell_currency']),
+        ])
+        frames.append(swap_rows)
+
+    if frames:
+        final_df = pd.concat(frames, ignore_index=True)
+    else:
+        final_df = pd.DataFrame(columns=target_columns)
 
-    print("DEBUG Dates")
-    print(final_df['Date'])   
+    # Fill NaN values in numeric columns with 0 for cleaner output CSV
+    for col in ['Buy', 'Sell', 'Fee']:
+        if col in final_df.columns:
+            final_df[col] = pd.to_numeric(final_df[col], errors='coerce').fillna(0)
 
+    with stage("sort", final_df) as record:
+        final_df = sort_consolidated_df(final_df)
+        record["rows_out"] = final_df
     return final_df
 
 # --- 3. Processing Workflows ---
 # --- WORKFLOW 1: For Leg-Based Formats (like Coinbase Pro) ---
 def process_to_intermediate_legs(input_df, config):
-    renamed_df = input_df.rename(columns=config["column_mapping"])
-    for _, raw_col in config["column_mapping"].items():
-        if raw_col not in renamed_df.columns:
-            renamed_df[raw_col] = np.nan
+    with stage("rename", input_df) as record:
+        renamed_df = input_df.rename(columns=config["column_mapping"])
+        for _, raw_col in config["column_mapping"].items():
+            if raw_col not in renamed_df.columns:
+                renamed_df[raw_col] = np.nan
+        record["rows_out"] = renamed_df
+
+    with stage("transform", renamed_df) as record:
+        intermediate_df = _transform_legs(renamed_df, config)
+        record["rows_out"] = intermediate_df
+    return intermediate_df
 
+def _transform_legs(renamed_df, config):
     intermediate_df = pd.DataFrame()
-    intermediate_df['Type_Intermediate'] = renamed_df.apply(
-        lambda row: transformation_actions["map_transaction_type"](row.get('Transaction_Type_Raw')), axis=1
-    )
+    intermediate_df['Type_Intermediate'] = apply_transformation(renamed_df, "map_transaction_type", 'Transaction_Type_Raw')
     intermediate_df['DateTime_Raw'] = renamed_df['DateTime_Raw']
     intermediate_df['Amount_Raw'] = pd.to_numeric(renamed_df['Amount_Raw'], errors='coerce')
     intermediate_df['Currency_Raw'] = renamed_df['Currency_Raw']
@@ -494,31 +801,31 @@ def process_to_intermediate_legs(input_df, config):
     intermediate_df['Transfer_ID_Raw'] = renamed_df['Transfer_ID_Raw']
 
     for target_col, transform_def in config["transformations"].items():
-        action = transform_def["action"]
-        source_cols = transform_def["source"]
-        if isinstance(source_cols, str):
-            intermediate_df[target_col] = renamed_df.apply(
-                lambda row: transformation_actions[action](row.get(source_cols)), axis=1
-            )
-        else:
-            intermediate_df[target_col] = renamed_df.apply(
-                lambda row: transformation_actions[action](*[row.get(col) for col in source_cols]), axis=1
-            )
+        intermediate_df[target_col] = apply_transformation(renamed_df, transform_def["action"], transform_def["source"])
 
     for col, value in config["static_values"].items():
         intermediate_df[col] = value
     #intermediate_df['Add Date'] = datetime.now().strftime('%Y-%m-%d')
     return intermediate_df
 
-def consolidate_legs_to_final_df(intermediate_df, config):
+def consolidate_legs_to_final_df(intermediate_df, config, engine="rows"):
     # This is your original 'consolidate_trade_rows' function
     # It remains unchanged, as its logic is sound for its purpose.
+    # The columnar engine uses the single-pass grouped version instead.
+    if engine == "columnar":
+        return consolidate_trade_rows_grouped(intermediate_df, config)
     final_df = consolidate_trade_rows(intermediate_df, config)
     return final_df
 
 # --- WORKFLOW 2 UPGRADED: Direct Processing Function for Pre-Consolidated Formats ---
+def _text_value(value):
+    # str(value).strip() for a present value, '' for a missing one (blank cells read as NaN)
+    return '' if pd.isna(value) else str(value).strip()
+
 def process_csv_direct(input_df, config):
-    renamed_df = input_df.rename(columns=config["column_mapping"])
+    with stage("rename", input_df) as record:
+        renamed_df = input_df.rename(columns=config["column_mapping"])
+        record["rows_out"] = renamed_df
     final_rows = []
     platform = config["platform_name"]
 
@@ -616,7 +923,7 @@ def process_csv_direct(input_df, config):
             if (row.get('Primary_Asset_Raw') is not None and row.get('Primary_Amount_Raw') is not None):
                 new_row['Buy'] = pd.to_numeric(row.get('Primary_Amount_Raw'), errors='coerce')
                 new_row['Cur.'] = row.get('Primary_Asset_Raw')
-                print("DEBUG Deposit found")
+                logging.debug("Deposit found")
             else:
                 if (currency is not None and (row.get('Buy_Amount_Raw') is not None and row.get('Buy_Amount_Raw') != 0)):
                     new_row['Buy'] = pd.to_numeric(row.get('Buy_Amount_Raw'), errors='coerce')
@@ -683,7 +990,7 @@ def process_csv_direct(input_df, config):
             if (currency is not None and (row.get('Buy_Amount_Raw') is not None and row.get('Buy_Amount_Raw') != 0)):
                 new_row['Buy'] = pd.to_numeric(row.get('Buy_Amount_Raw'), errors='coerce')
                 new_row['Cur.'] = currency
-            comment = row.get('OG_Comment_Raw', '').strip()
+            comment = _text_value(row.get('OG_Comment_Raw', ''))
             if ('undelegated' in comment.lower() and '[' in comment and ']' in comment):
                 add_row['Type'] = 'Deposit'
                 add_row['Date'] = extract_datetime_combined(row.get('DateTime_Raw'))
@@ -740,7 +1047,7 @@ def process_csv_direct(input_df, config):
                 add_row['Buy'] = pd.to_numeric(row.get('Sell_Amount_Raw'), errors='coerce')
                 add_row['Cur.'] = pair_currency
             else:
-                comment = row.get('OG_Comment_Raw', '').strip().replace('[', '').replace(']', '')
+                comment = _text_value(row.get('OG_Comment_Raw', '')).replace('[', '').replace(']', '')
                 if 'delegated' in comment.lower():
                     comment2 = comment.split(' ')
                     if len(comment2) > 2:
@@ -764,7 +1071,7 @@ def process_csv_direct(input_df, config):
                 add_row['Sell'] = pd.to_numeric(row.get('Buy_Amount_Raw'), errors='coerce')
                 add_row['Cur..1'] = currency
             else:
-                comment = row.get('OG_Comment_Raw', '').strip().replace('[', '').replace(']', '')
+                comment = _text_value(row.get('OG_Comment_Raw', '')).replace('[', '').replace(']', '')
                 if 'undelegated' in comment.lower():
                     comment2 = comment.split(' ')
                     if len(comment2) > 2:
@@ -805,40 +1112,673 @@ def process_csv_direct(input_df, config):
         final_rows.append(new_row)
 
     final_df = pd.DataFrame(final_rows, columns=config["target_columns"])
+    with stage("sort", final_df) as record:
+        final_df = finalize_direct_df(final_df)
+        record["rows_out"] = final_df
+    return final_df
 
+def finalize_direct_df(final_df):
     # Final cleaning and sorting
     for col in ['Buy', 'Sell', 'Fee']:
         if col in final_df.columns:
             final_df[col] = pd.to_numeric(final_df[col], errors='coerce').fillna(0)
 
     if not final_df.empty and 'Date' in final_df.columns:
-        final_df['Sort_DateTime'] = pd.to_datetime(final_df['Date'], format='%d-%m-%Y %H:%M:%S', errors='coerce')
-        final_df = final_df.sort_values(by='Sort_DateTime', na_position='first').drop(columns=['Sort_DateTime'])
+        # The columnar engine brings its own parsed Sort_DateTime; otherwise parse the formatted Date
+        if 'Sort_DateTime' not in final_df.columns:
+            final_df['Sort_DateTime'] = pd.to_datetime(final_df['Date'], format=OUTPUT_DATETIME_FORMAT, errors='coerce')
+        # Stable, so rows with the same timestamp keep their order
+        final_df = final_df.sort_values(by='Sort_DateTime', na_position='first', kind='stable')
         final_df['Date'] = final_df['Date'].astype(str)
 
+    return final_df.drop(columns=['Sort_DateTime'], errors='ignore')
+
+# --- WORKFLOW 2 COLUMNAR: Same rules as process_csv_direct, applied to whole columns ---
+# Category branches in the same order as the if/elif chain in process_csv_direct.
+# Anything that matches none of them is treated as a trade.
+DIRECT_CATEGORY_BRANCHES = [
+    ("spam", ['spam']),
+    ("transfer", ['transfer']),
+    ("deposit", ['deposit', 'transfer in', 'top up crypto', 'top up', 'receive']),
+    ("withdrawal", ['withdrawal', 'transfer out', 'send', 'crypto send']),
+    ("spend", ['spend']),
+    ("convert", ['convert']),
+    ("airdrop", ['airdrop']),
+    ("gift", ['gift', 'tip']),
+    ("reward", ['referral bonus', 'reward', 'bonus']),
+    ("income", ['income']),
+    ("other_income", ['other income', 'other_income']),
+    ("other_fee", ['_self_transfer', '_unknown']),
+    ("staking", ['staking', 'fixed term interest', 'staking reward', 'staking_reward', 'stake reward']),
+    ("stake", ['_msgdelegate', 'locking term deposit', 'stake']),
+    ("unstake", ['unlocking term deposit', 'unstake']),  # plus any category containing 'undelegate'
+    ("interest", ['interest', 'interest_payment', 'interest payment']),
+]
+
+# Branches that only record the received amount under a fixed type
+DIRECT_INCOME_TYPES = {
+    "airdrop": 'Airdrop',
+    "gift": 'Gift / Tip',
+    "reward": 'Reward / Bonus',
+    "income": 'Income',
+    "other_income": 'Other Income',
+}
+
+def _raw_column(renamed_df, col, default=''):
+    # Column-wise equivalent of row.get(col, default)
+    if col in renamed_df.columns:
+        return renamed_df[col]
+    return pd.Series(default, index=renamed_df.index, dtype=object)
+
+def _text_column(series):
+    # str(value).strip() for present values, '' for missing ones
+    return series.astype(str).where(series.notna(), '').str.strip()
+
+def _lower_column(series):
+    # str(value).lower(), including 'nan' for missing values
+    return series.astype(str).fillna('nan').str.lower()
+
+def _before_semicolon(series):
+    return series.str.split(';').str[0].str.strip()
+
+def _nonzero_mask(renamed_df, col):
+    # row.get(col) is not None and row.get(col) != 0
+    if col not in renamed_df.columns:
+        return pd.Series(False, index=renamed_df.index)
+    return renamed_df[col].ne(0)
+
+def _numeric_column(renamed_df, col):
+    if col not in renamed_df.columns:
+        return pd.Series(np.nan, index=renamed_df.index)
+    return pd.to_numeric(renamed_df[col], errors='coerce')
+
+def _staking_exchange(exchange, keyword):
+    lowered = exchange.fillna('').astype(str).str.lower()
+    return lowered.str.replace(keyword, 'staking', regex=False).where(lowered.str.contains(keyword, regex=False), 'staking')
+
+def process_csv_columnar(input_df, config, datetime_format=None):
+    with stage("rename", input_df) as record:
+        renamed_df = input_df.rename(columns=config["column_mapping"]).reset_index(drop=True)
+        record["rows_out"] = renamed_df
+    platform = config["platform_name"]
+    target_columns = config["target_columns"]
+    is_pair = config["consolidation_style"] == "pair"
+    n = len(renamed_df)
+
+    # One object array per target column for the main row and the two optional extra rows
+    new_row = {col: np.full(n, '', dtype=object) for col in target_columns}
+    add_row = {col: np.full(n, '', dtype=object) for col in target_columns}
+    add_row2 = {col: np.full(n, '', dtype=object) for col in target_columns}
+
+    def put(rows, col, mask, values):
+        mask = np.asarray(mask, dtype=bool)
+        if isinstance(values, (pd.Series, np.ndarray)):
+            rows[col][mask] = np.asarray(values, dtype=object)[mask]
+        else:
+            rows[col][mask] = values
+
+    # --- Populate Common Fields ---
+    wall_times = parse_datetime_column(_raw_column(renamed_df, 'DateTime_Raw', np.nan), datetime_format)
+    date = format_datetime_values(wall_times)
+    maincomment = _raw_column(renamed_df, 'Comment_Raw')
+    exchange = _raw_column(renamed_df, 'Exchange_Raw', platform)
+    group = _before_semicolon(_text_column(_raw_column(renamed_df, 'Group_Raw')))
+    operation = _lower_column(_raw_column(renamed_df, 'Operation_Raw'))
+    category = _lower_column(_raw_column(renamed_df, 'Category_Raw'))
+    currency = _before_semicolon(_text_column(_raw_column(renamed_df, 'Currency_Raw')))
+    pair_currency = _before_semicolon(_text_column(_raw_column(renamed_df, 'Pair_Currency_Raw')))
+    fee_currency = _before_semicolon(_text_column(_raw_column(renamed_df, 'Fee_Currency_Raw')))
+
+    everyone = np.ones(n, dtype=bool)
+    put(new_row, 'Date', everyone, date)
+    put(new_row, 'Exchange', everyone, exchange)
+    put(new_row, 'Group', everyone, group)
+    put(new_row, 'Fee', everyone, _numeric_column(renamed_df, 'Fee_Raw'))
+    put(new_row, 'Cur..2', everyone, fee_currency)
+
+    buy = _numeric_column(renamed_df, 'Buy_Amount_Raw')
+    sell = _numeric_column(renamed_df, 'Sell_Amount_Raw')
+    has_buy = _nonzero_mask(renamed_df, 'Buy_Amount_Raw')
+    has_sell = _nonzero_mask(renamed_df, 'Sell_Amount_Raw')
+    has_currency = currency != ''
+    has_pair_currency = pair_currency != ''
+    has_primary = 'Primary_Asset_Raw' in renamed_df.columns and 'Primary_Amount_Raw' in renamed_df.columns
+
+    if is_pair:
+        # Like MEXC, when we need to handle pairs separately
+        pair = _raw_column(renamed_df, 'Pair_Raw').fillna('').astype(str)
+        base = pair.copy()
+        quote = pd.Series('', index=pair.index, dtype=object)
+        unsplit = pair != ''
+        for separator in ['_', '-', '/', ';', ' ']:
+            split_here = unsplit & pair.str.contains(separator, regex=False)
+            parts = pair[split_here].str.split(separator, n=1)
+            base[split_here] = parts.str[0]
+            quote[split_here] = parts.str[1]
+            unsplit &= ~split_here
+        base = base.str.strip()
+        quote = quote.astype(str).str.strip()
+        has_pair = pair != ''
+        pair_buy = has_pair & (operation == 'buy')
+        pair_sell = has_pair & (operation == 'sell')
+        put(new_row, 'Cur.', pair_buy, base)
+        put(new_row, 'Cur..1', pair_buy, quote)
+        put(new_row, 'Cur..2', pair_buy, fee_currency)
+        put(new_row, 'Cur.', pair_sell, quote)
+        put(new_row, 'Cur..1', pair_sell, base)
+        put(new_row, 'Cur..2', pair_sell, fee_currency)
+        put(new_row, 'Cur.', ~has_pair, currency)
+        put(new_row, 'Cur..1', ~has_pair, pair_currency)
+
+    # --- Sort every row into exactly one category branch ---
+    conditions = []
+    for name, categories in DIRECT_CATEGORY_BRANCHES:
+        condition = category.isin(categories)
+        if name == "unstake":
+            condition |= category.str.contains('undelegate', regex=False)
+        conditions.append(condition.to_numpy())
+    branch = np.select(conditions, [name for name, _ in DIRECT_CATEGORY_BRANCHES], default="trade")
+    is_branch = {name: branch == name for name, _ in DIRECT_CATEGORY_BRANCHES}
+    is_branch["trade"] = branch == "trade"
+
+    has_add = np.zeros(n, dtype=bool)
+    has_add2 = np.zeros(n, dtype=bool)
+    comment_prefix = pd.Series('', index=renamed_df.index, dtype=object)
+
+    # Transfers: wallet to wallet when both currencies are present
+    both = is_branch["transfer"] & has_currency & has_pair_currency
+    put(new_row, 'Type', both, 'Deposit')
+    put(add_row, 'Type', both, 'Withdrawal')
+    put(new_row, 'Buy', both & has_buy, buy)
+    put(new_row, 'Cur.', both & has_buy, currency)
+    put(new_row, 'Exchange', both & has_buy, _raw_column(renamed_df, 'Group_Raw'))
+    put(add_row, 'Sell', both & has_sell, sell)
+    put(add_row, 'Cur..1', both & has_sell, pair_currency)
+    put(add_row, 'Exchange', both & has_sell, exchange)
+    has_add |= np.asarray(both)
+    transfer_in = is_branch["transfer"] & ~both & has_currency & has_buy
+    put(new_row, 'Type', transfer_in, 'Deposit')
+    put(new_row, 'Buy', transfer_in, buy)
+    put(new_row, 'Cur.', transfer_in, currency)
+    transfer_out = is_branch["transfer"] & ~both & ~transfer_in & has_pair_currency & has_sell
+    put(new_row, 'Type', transfer_out, 'Withdrawal')
+    put(new_row, 'Sell', transfer_out, sell)
+    put(new_row, 'Cur..1', transfer_out, pair_currency)
+
+    # Deposits and withdrawals, preferring the primary asset columns when the export has them
+    deposit = is_branch["deposit"]
+    put(new_row, 'Type', deposit, np.where(operation == 'reward', 'Reward / Bonus', 'Deposit'))
+    withdrawal = is_branch["withdrawal"]
+    put(new_row, 'Type', withdrawal, 'Withdrawal')
+    if has_primary:
+        primary_asset = renamed_df['Primary_Asset_Raw']
+        primary_amount = pd.to_numeric(renamed_df['Primary_Amount_Raw'], errors='coerce')
+        put(new_row, 'Buy', deposit, primary_amount)
+        put(new_row, 'Cur.', deposit, primary_asset)
+        put(new_row, 'Sell', withdrawal, primary_amount)
+        put(new_row, 'Cur..1', withdrawal, primary_asset)
+    else:
+        put(new_row, 'Buy', deposit & has_buy, buy)
+        put(new_row, 'Cur.', deposit & has_buy, currency)
+        put(new_row, 'Sell', withdrawal & has_sell, sell)
+        put(new_row, 'Cur..1', withdrawal & has_sell, pair_currency)
+
+    spend = is_branch["spend"]
+    put(new_row, 'Type', spend, 'Spend')
+    put(new_row, 'Sell', spend & has_sell, sell)
+    put(new_row, 'Cur..2', spend & has_sell, pair_currency)
+
+    # Converts: Base is what you sold, Quote is what you bought
+    convert = is_branch["convert"]
+    wrapped = ((currency.str.lower() == "w" + pair_currency.str.lower())
+               | (pair_currency.str.lower() == "w" + currency.str.lower()))
+    put(new_row, 'Type', convert & wrapped, 'Swap (non taxable)')
+    put(new_row, 'Type', convert & ~wrapped, 'Trade')
+    put(new_row, 'Sell', convert, buy)
+    put(new_row, 'Buy', convert, sell)
+    convert_currencies = convert & wrapped if is_pair else convert
+    put(new_row, 'Cur..1', convert_currencies, currency)
+    put(new_row, 'Cur.', convert_currencies, pair_currency)
+
+    for name, type_name in DIRECT_INCOME_TYPES.items():
+        put(new_row, 'Type', is_branch[name], type_name)
+        put(new_row, 'Buy', is_branch[name] & has_buy, buy)
+        put(new_row, 'Cur.', is_branch[name] & has_buy, currency)
+
+    put(new_row, 'Type', is_branch["other_fee"], 'Other Fee')
+
+    # Staking rewards, with delegations described in the original comment as "[delegated 20 TIA]"
+    og_comment = _text_column(_raw_column(renamed_df, 'OG_Comment_Raw'))
+    og_lower = og_comment.str.lower()
+    bracketed = og_comment.str.contains('[', regex=False) & og_comment.str.contains(']', regex=False)
+    bracket_words = og_comment.str.split('[').str[1].fillna('').str.split(']').str[0].str.split(' ')
+    bracket_amount = pd.to_numeric(bracket_words.str[1], errors='coerce')
+    bracket_currency = bracket_words.str[2].fillna('').str.strip()
+    has_bracket_amount = bracket_words.str.len() > 2
+
+    staking = is_branch["staking"]
+    put(new_row, 'Type', staking, 'Staking')
+    put(new_row, 'Buy', staking & has_buy, buy)
+    put(new_row, 'Cur.', staking & has_buy, currency)
+    undelegated = staking & bracketed & og_lower.str.contains('undelegated', regex=False)
+    delegated = staking & bracketed & ~undelegated & og_lower.str.contains('delegated', regex=False)
+    comment_prefix[undelegated] = 'UNSTAKING     '
+    comment_prefix[delegated] = 'STAKING     '
+    for mask, inflow, outflow in [(undelegated, add_row, add_row2), (delegated, add_row2, add_row)]:
+        put(inflow, 'Type', mask, 'Deposit')
+        put(outflow, 'Type', mask, 'Withdrawal')
+        put(add_row, 'Exchange', mask, exchange)
+        put(add_row2, 'Exchange', mask, _staking_exchange(exchange, 'blockchain'))
+        put(inflow, 'Buy', mask & has_bracket_amount, bracket_amount)
+        put(inflow, 'Cur.', mask & has_bracket_amount, bracket_currency)
+        put(outflow, 'Sell', mask & has_bracket_amount, bracket_amount)
+        put(outflow, 'Cur..1', mask & has_bracket_amount, bracket_currency)
+        has_add |= np.asarray(mask)
+        has_add2 |= np.asarray(mask)
+
+    # Stake / unstake: mirror the movement into a staking account, falling back to the original comment
+    plain_words = og_comment.str.replace('[', '', regex=False).str.replace(']', '', regex=False).str.split(' ')
+    plain_amount = pd.to_numeric(plain_words.str[1], errors='coerce')
+    plain_currency = plain_words.str[2].fillna('').str.strip()
+    has_plain_amount = plain_words.str.len() > 2
+
+    stake = is_branch["stake"]
+    put(new_row, 'Type', stake, 'Withdrawal')
+    put(add_row, 'Type', stake, 'Deposit')
+    put(add_row, 'Exchange', stake, _staking_exchange(exchange, 'wallet'))
+    comment_prefix[stake] = 'STAKING     '
+    stake_sent = stake & has_pair_currency & has_sell
+    put(new_row, 'Sell', stake_sent, sell)
+    put(new_row, 'Cur..1', stake_sent, pair_currency)
+    put(add_row, 'Buy', stake_sent, sell)
+    put(add_row, 'Cur.', stake_sent, pair_currency)
+    stake_comment = stake & ~stake_sent & og_lower.str.contains('delegated', regex=False) & has_plain_amount
+    put(new_row, 'Sell', stake_comment, plain_amount)
+    put(new_row, 'Cur..1', stake_comment, plain_currency)
+    put(add_row, 'Buy', stake_comment, plain_amount)
+    put(add_row, 'Cur.', stake_comment, plain_currency)
+    has_add |= np.asarray(stake)
+
+    unstake = is_branch["unstake"]
+    put(new_row, 'Type', unstake, 'Deposit')
+    put(add_row, 'Type', unstake, 'Withdrawal')
+    put(add_row, 'Exchange', unstake, _staking_exchange(exchange, 'blockchain'))
+    comment_prefix[unstake] = 'UNSTAKING     '
+    unstake_received = unstake & has_currency & has_buy
+    put(new_row, 'Buy', unstake_received, buy)
+    put(new_row, 'Cur.', unstake_received, currency)
+    put(add_row, 'Sell', unstake_received, buy)
+    put(add_row, 'Cur..1', unstake_received, currency)
+    unstake_comment = unstake & ~unstake_received & og_lower.str.contains('undelegated', regex=False) & has_plain_amount
+    put(new_row, 'Buy', unstake_comment, plain_amount)
+    put(new_row, 'Cur.', unstake_comment, plain_currency)
+    put(add_row, 'Sell', unstake_comment, plain_amount)
+    put(add_row, 'Cur..1', unstake_comment, plain_currency)
+    has_add |= np.asarray(unstake)
+
+    # Interest: positive amounts are income, negative ones are fees; USD interest is not crypto
+    interest = is_branch["interest"]
+    interest_in = interest & has_buy & (buy > 0)
+    interest_out = interest & has_buy & (buy < 0)
+    put(new_row, 'Type', interest_in, 'Interest Income')
+    put(new_row, 'Buy', interest_in, buy)
+    put(new_row, 'Cur.', interest_in, currency)
+    put(new_row, 'Type', interest_out, 'Other Fee')
+    put(new_row, 'Sell', interest_out, buy.abs())
+    put(new_row, 'Cur..1', interest_out, currency)
+
+    # Everything else is a trade; if operation is not specified, assume it's normal buy trade
+    trade = is_branch["trade"]
+    trade_buy = trade & operation.isin(['', 'buy'])
+    trade_sell = trade & (operation == 'sell')
+    put(new_row, 'Type', trade, 'Trade')
+    put(new_row, 'Buy', trade_buy, buy)
+    put(new_row, 'Sell', trade_buy, sell)
+    put(new_row, 'Sell', trade_sell, buy)
+    put(new_row, 'Buy', trade_sell, sell)
+    if not is_pair:
+        put(new_row, 'Cur.', trade_buy, currency)
+        put(new_row, 'Cur..1', trade_buy, pair_currency)
+        put(new_row, 'Cur..1', trade_sell, currency)
+        put(new_row, 'Cur.', trade_sell, pair_currency)
+
+    # Comments, including the STAKING / UNSTAKING prefix shared with the extra rows
+    prefixed = (comment_prefix != '').to_numpy()
+    prefixed_comment = comment_prefix + _text_column(maincomment)
+    put(new_row, 'Comment', everyone, maincomment)
+    put(new_row, 'Comment', prefixed, prefixed_comment)
+    for rows, mask in [(add_row, has_add), (add_row2, has_add2)]:
+        dated = mask & prefixed
+        put(rows, 'Date', dated, date)
+        put(rows, 'Comment', dated, prefixed_comment)
+
+    # Skip spam entries and USD interest
+    keep = ~is_branch["spam"] & ~(interest & (currency.str.lower() == 'usd')).to_numpy()
+
+    # Lay the rows out as the row-by-row loop does: extra rows first, then the main row
+    positions = np.arange(n)
+    parts = []
+    for slot, (rows, mask) in enumerate([(add_row, has_add & keep), (add_row2, has_add2 & keep), (new_row, keep)]):
+        part = pd.DataFrame({col: values[mask] for col, values in rows.items()}, columns=target_columns)
+        # Extra rows only carry a date when they copy the main row's comment
+        sort_datetime = wall_times.to_numpy() if slot == 2 else np.where(mask & prefixed, wall_times.to_numpy(), np.datetime64('NaT'))
+        part['Sort_DateTime'] = sort_datetime[mask]
+        part['_position'] = positions[mask]
+        part['_slot'] = slot
+        parts.append(part)
+    final_df = pd.concat(parts, ignore_index=True)
+    order = np.lexsort((final_df['_slot'].to_numpy(), final_df['_position'].to_numpy()))
+    final_df = final_df.iloc[order].drop(columns=['_position', '_slot']).reset_index(drop=True)
+
+    with stage("sort", final_df) as record:
+        final_df = finalize_direct_df(final_df)
+        record["rows_out"] = final_df
     return final_df
 
+# --- Format Detection: pick the config for a file from its header line ---
+def _normalize_header(header):
+    return str(header).replace('\ufeff', '').strip().lower()
+
+def build_header_index(configs):
+    """Maps each normalized header to the configs that list it, so scoring a file only touches its own columns."""
+    header_index = {}
+    for name, config in configs.items():
+        for header in set(map(_normalize_header, config["identification_headers"])):
+            header_index.setdefault(header, []).append((name, "identification"))
+        for header in set(map(_normalize_header, config["column_mapping"])):
+            header_index.setdefault(header, []).append((name, "mapping"))
+    return header_index
+
+HEADER_INDEX = build_header_index(CONFIGS)
+
+def _header_scores(columns, configs, header_index):
+    # Share of each config's identification headers (weighted 0.8) and mapped columns (0.2) present in the file
+    hits = {name: {"identification": 0, "mapping": 0} for name in configs}
+    for header in set(map(_normalize_header, columns)):
+        for name, kind in header_index.get(header, ()):
+            if name in hits:
+                hits[name][kind] += 1
+    scores = {}
+    for name, config in configs.items():
+        identification = len(set(map(_normalize_header, config["identification_headers"])))
+        mapping = len(set(map(_normalize_header, config["column_mapping"])))
+        scores[name] = (0.8 * hits[name]["identification"] / max(identification, 1)
+                        + 0.2 * hits[name]["mapping"] / max(mapping, 1))
+    return scores
+
+def _sample_score(sample_df, config):
+    # Share of sample values that parse as the kind of data the config maps them to
+    columns = {_normalize_header(col): col for col in sample_df.columns}
+    checked = 0
+    readable = 0
+    for raw_col, mapped in config["column_mapping"].items():
+        col = columns.get(_normalize_header(raw_col))
+        if col is None:
+            continue
+        values = sample_df[col].dropna()
+        if values.empty:
+            continue
+        if mapped == 'DateTime_Raw':
+            parsed = pd.to_datetime(values.astype(str), errors='coerce', format='mixed')
+        elif mapped in ('Buy_Amount_Raw', 'Sell_Amount_Raw', 'Fee_Raw', 'Amount_Raw'):
+            parsed = pd.to_numeric(values, errors='coerce')
+        else:
+            continue
+        checked += len(values)
+        readable += parsed.notna().sum()
+    return readable / checked if checked else 0.0
+
+def detect_config_from_columns(columns, sample_df=None, configs=None):
+    """
+    Scores every config against a file's columns and returns (config_name, confidence).
+
+    Confidence is between 0 and 1. When configs tie on headers and sample_df is given,
+    the config whose date and amount columns parse best on the sample wins; a tie that
+    is still open splits the confidence between the tied configs.
+    Returns (None, 0.0) when no config shares a single header with the file.
+    """
+    if configs is None:
+        configs = CONFIGS
+    header_index = HEADER_INDEX if configs is CONFIGS else build_header_index(configs)
+    scores = _header_scores(columns, configs, header_index)
+
+    best_score = max(scores.values(), default=0.0)
+    if best_score == 0:
+        return None, 0.0
+    tied = [name for name, score in scores.items() if np.isclose(score, best_score)]
+    if len(tied) > 1 and sample_df is not None and not sample_df.empty:
+        sample_scores = {name: _sample_score(sample_df, configs[name]) for name in tied}
+        best_sample = max(sample_scores.values())
+        tied = [name for name in tied if np.isclose(sample_scores[name], best_sample)]
+    return tied[0], best_score / len(tied)
+
+def read_header_sample(source, sample_rows=20):
+    """Reads the header line and the first sample_rows rows of a CSV or Excel export. File objects are rewound afterwards."""
+    name = source if isinstance(source, (str, os.PathLike)) else getattr(source, 'name', '')
+    position = source.tell() if hasattr(source, 'seek') else None
+    try:
+        if str(name).lower().endswith(('.xlsx', '.xls')):
+            return pd.read_excel(source, nrows=sample_rows)
+        return pd.read_csv(source, nrows=sample_rows)
+    finally:
+        if position is not None:
+            source.seek(position)
+
+def detect_config(source, sample_rows=20, configs=None):
+    """
+    Detects the format of an export from its header line, without reading the whole file.
+
+    source is a path, a file object, or an already loaded DataFrame.
+    Returns (config_name, confidence), see detect_config_from_columns.
+    """
+    sample_df = source if isinstance(source, pd.DataFrame) else read_header_sample(source, sample_rows)
+    return detect_config_from_columns(sample_df.columns, sample_df.head(sample_rows), configs)
+
+def resolve_config(source, config=None, min_confidence=0.5):
+    # Returns the config to use for source, detecting it when none was given
+    if config is not None:
+        return config
+    config_name, confidence = detect_config(source)
+    if config_name is None or confidence < min_confidence:
+        raise ValueError(f"Could not detect the format of the file (best match: {config_name}, "
+                         f"confidence {confidence:.2f}). Pick the format explicitly.")
+    print(f"Detected format: {config_name} (confidence {confidence:.2f}).")
+    return CONFIGS[config_name]
+
+
 # --- 4. Main Controller Function ---
-def process_file(input_df, config):
+ENGINES = ("rows", "columnar")
+
+def process_file(input_df, config=None, engine="rows", recorder=None):
     """
     Processes the input DataFrame based on the consolidation style specified in the config.
+
+    engine="rows" walks the file row by row; engine="columnar" applies the same rules
+    to whole columns at once, which is much faster on large exports.
+    With config=None the format is detected from the DataFrame's columns.
+    Pass an instrumentation.StageRecorder as recorder to time the rename, transform,
+    consolidate and sort stages. Direct formats have no consolidate stage; their
+    rename and sort stages run inside transform.
     """
-    style = config.get("consolidation_style")
+    with recording(recorder):
+        config = resolve_config(input_df, config)
+        style = config.get("consolidation_style")
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine: '{engine}'. Expected one of {ENGINES}.")
+
+        if style == "by_trade_id_and_time":
+            print(f"Using leg-based consolidation for {config['platform_name']}...")
+            # NOTE: 'consolidate_legs_to_final_df' would be your original 'consolidate_trade_rows' function
+            intermediate_df = process_to_intermediate_legs(input_df, config)
+            with stage("consolidate", intermediate_df) as record:
+                final_df = consolidate_legs_to_final_df(intermediate_df, config, engine=engine)
+                record["rows_out"] = final_df
+            return final_df
+
+        elif style == "direct" or style == "pair":
+            print(f"Using direct processing for {config['platform_name']}...")
+            with stage("transform", input_df) as record:
+                if engine == "columnar":
+                    final_df = process_csv_columnar(input_df, config)
+                else:
+                    final_df = process_csv_direct(input_df, config)
+                record["rows_out"] = final_df
+            return final_df
 
-    if style == "by_trade_id_and_time":
-        print(f"Using leg-based consolidation for {config['platform_name']}...")
-        # NOTE: 'consolidate_legs_to_final_df' would be your original 'consolidate_trade_rows' function
-        intermediate_df = process_to_intermediate_legs(input_df, config)
-        final_df = consolidate_legs_to_final_df(intermediate_df, config)
-        return final_df
-        
-    elif style == "direct" or style == "pair":
-        print(f"Using direct processing for {config['platform_name']}...")
-        final_df = process_csv_direct(input_df, config)
-        return final_df
-        
-    else:
-        raise ValueError(f"Unknown consolidation_style: '{style}' in config for {config['platform_name']}.")
+        else:
+            raise ValueError(f"Unknown consolidation_style: '{style}' in config for {config['platform_name']}.")
 
 
+# --- 5. Streaming Controller for Very Large Exports ---
+def _spill_sorted_run(final_df, directory, run_index, na_position='first'):
+    # Write one formatted, date-sorted chunk with its sort key in front
+    sort_key = pd.to_datetime(final_df['Date'], format=OUTPUT_DATETIME_FORMAT, errors='coerce')
+    missing_key = np.iinfo(np.int64).min if na_position == 'first' else np.iinfo(np.int64).max
+    run = final_df.copy()
+    # A chunk of whole numbers would otherwise be written as 1000 rather than 1000.0
+    for col in ['Buy', 'Sell', 'Fee']:
+        if col in run.columns:
+            run[col] = run[col].astype(float)
+    run.insert(0, '_sort_key', np.where(sort_key.isna(), missing_key, sort_key.astype('int64')))
+    path = os.path.join(directory, f"run_{run_index:05d}.csv")
+    run.to_csv(path, index=False, lineterminator='\n')
+    return path
+
+def _read_run(path, run_index):
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row_number, row in enumerate(reader):
+            yield int(row[0]), run_index, row_number, row[1:]
+
+def consolidate_legs_streaming(chunks, config, engine="columnar", datetime_format=None):
+    """
+    Consolidates Coinbase Pro style legs chunk by chunk, yielding finished trades.
+
+    The export must be in time order (either direction). Legs that share the last
+    second of a chunk are carried into the next chunk since more legs of the same
+    (Trade ID, time) can still follow; everything else is consolidated and yielded
+    right away. Legs with no readable time can belong anywhere in the file, so they
+    are spilled to a temporary file and consolidated together at the end. Legs keep
+    their file order, so every trade gets the same legs, sums and comment as the
+    in-memory path.
+    """
+    carry = None
+    last_time = None
+    direction = 0
+
+    with tempfile.TemporaryFile() as undated_spill:
+        for chunk in chunks:
+            intermediate_df = process_to_intermediate_legs(chunk, config)
+            if carry is not None:
+                intermediate_df = pd.concat([carry, intermediate_df], ignore_index=True)
+            wall_times = parse_datetime_column(intermediate_df['DateTime_Raw'], datetime_format)
+
+            # Check that the export really is in time order before trusting the boundary
+            times = wall_times.dropna().to_numpy()
+            if last_time is not None:
+                times = np.concatenate([[last_time], times])
+            steps = np.sign(np.diff(times).astype('int64'))
+            steps = steps[steps != 0]
+            if len(steps):
+                if direction == 0:
+                    direction = steps[0]
+                if (steps != direction).any():
+                    raise ValueError(f"{config['platform_name']} export is not in time order; "
+                                     "sort it by time or use process_file instead.")
+            if len(times):
+                last_time = times[-1]
+
+            undated = wall_times.isna().to_numpy()
+            if undated.any():
+                pickle.dump(intermediate_df[undated], undated_spill)
+            still_open = ~undated & (wall_times == last_time).to_numpy()
+            carry = intermediate_df[still_open]
+            finished = intermediate_df[~undated & ~still_open]
+            if not finished.empty:
+                yield consolidate_legs_to_final_df(finished, config, engine=engine)
+
+        pieces = [carry] if carry is not None else []
+        undated_spill.seek(0)
+        while True:
+            try:
+                pieces.append(pickle.load(undated_spill))
+            except EOFError:
+                break
+        rest = pd.concat(pieces, ignore_index=True) if pieces else None
+        if rest is not None and not rest.empty:
+            yield consolidate_legs_to_final_df(rest, config, engine=engine)
+
+def process_file_streaming(source, config=None, output=None, chunksize=100_000, engine="columnar", **read_csv_kwargs):
+    """
+    Formats a CSV export without loading it into memory all at once.
+
+    The source (a path or file object) is read chunksize rows at a time. Each chunk is
+    formatted with the config, sorted by date and spilled to a temporary file, and the
+    sorted runs are k-way merged into output (a path or text file object). Peak memory
+    is set by chunksize rather than by the size of the file. Rows with the same
+    timestamp keep their order in the file.
 
+    Leg-based exports (by_trade_id_and_time) must be in time order, see
+    consolidate_legs_streaming.
+
+    With config=None the format is detected from the header line before streaming starts.
+
+    Returns the number of formatted rows written.
+    """
+    if output is None:
+        raise ValueError("process_file_streaming needs an output path or file object.")
+    config = resolve_config(source, config)
+    style = config.get("consolidation_style")
+    if style not in ("direct", "pair", "by_trade_id_and_time"):
+        raise ValueError(f"Unknown consolidation_style: '{style}' in config for {config['platform_name']}.")
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine: '{engine}'. Expected one of {ENGINES}.")
+
+    raw_datetime_col = next((raw for raw, mapped in config["column_mapping"].items() if mapped == 'DateTime_Raw'), None)
+    chunks = pd.read_csv(source, chunksize=chunksize, **read_csv_kwargs)
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
+        chunks = iter([])
+        datetime_format = None
+    else:
+        # Infer the date format once per file, from the first chunk
+        datetime_format = infer_datetime_format(first_chunk[raw_datetime_col]) if raw_datetime_col in first_chunk.columns else None
+        chunks = _chain_chunk(first_chunk, chunks)
+
+    if style == "by_trade_id_and_time":
+        formatted_chunks = consolidate_legs_streaming(chunks, config, engine=engine, datetime_format=datetime_format)
+        na_position = 'last'
+    elif engine == "columnar":
+        formatted_chunks = (process_csv_columnar(chunk, config, datetime_format=datetime_format) for chunk in chunks)
+        na_position = 'first'
+    else:
+        formatted_chunks = (process_csv_direct(chunk, config) for chunk in chunks)
+        na_position = 'first'
+
+    rows_written = 0
+    with tempfile.TemporaryDirectory() as spill_dir:
+        run_paths = []
+        for final_df in formatted_chunks:
+            run_paths.append(_spill_sorted_run(final_df, spill_dir, len(run_paths), na_position))
+            print(f"Formatted chunk {len(run_paths)} of {config['platform_name']} ({len(final_df)} rows).")
+
+        runs = [_read_run(path, run_index) for run_index, path in enumerate(run_paths)]
+        output_file = open(output, 'w', newline='') if isinstance(output, (str, os.PathLike)) else output
+        try:
+            writer = csv.writer(output_file, lineterminator='\n')
+            writer.writerow(config["target_columns"])
+            for _, _, _, row in heapq.merge(*runs):
+                writer.writerow(row)
+                rows_written += 1
+        finally:
+            for run in runs:
+                run.close()
+            if output_file is not output:
+                output_file.close()
+
+    return rows_written
+
+def _chain_chunk(first_chunk, chunks):
+    yield first_chunk
+    yield from chunks
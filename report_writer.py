@@ -0,0 +1,250 @@
+# report_writer.py
+import io
+import os
+import zipfile
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+
+import pandas as pd
+
+try:
+    import xlsxwriter
+except ImportError:
+    # Without xlsxwriter, workbooks are streamed with openpyxl's write-only mode
+    xlsxwriter = None
+
+REPORT_FORMATS = ('xlsx', 'csv', 'parquet', 'feather')
+
+
+class OutputDirectory:
+    """Writes report files into a directory."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def path_of(self, name):
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def open(self, name):
+        path = self.path_of(name)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as f:
+            yield f
+
+
+class OutputBundle:
+    """
+    Keeps report files in memory instead of writing them to disk.
+
+    Pass one wherever an output directory is expected; file paths are then just the
+    file names. close() returns the files as a dict of name -> BytesIO, or with
+    zipped=True as one zip archive in a BytesIO. When zipped, each file is compressed
+    on a background thread as soon as it is finished, while the next one is generated.
+    """
+
+    def __init__(self, zipped=False):
+        self.zipped = zipped
+        self.files = {}
+        if zipped:
+            self.buffer = io.BytesIO()
+            self.archive = zipfile.ZipFile(self.buffer, 'w', compression=zipfile.ZIP_DEFLATED)
+            # One worker, so only it touches the archive
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            self.pending = []
+
+    def path_of(self, name):
+        return name
+
+    @contextmanager
+    def open(self, name):
+        buffer = io.BytesIO()
+        yield buffer
+        if self.zipped:
+            self.pending.append(self.executor.submit(self.archive.writestr, name, buffer.getvalue()))
+        else:
+            buffer.seek(0)
+            self.files[name] = buffer
+
+    def close(self):
+        if not self.zipped:
+            return self.files
+        for future in self.pending:
+            future.result()
+        self.executor.shutdown()
+        self.archive.close()
+        self.buffer.seek(0)
+        return self.buffer
+
+
+def as_output(output_path):
+    """An output directory path, or an OutputDirectory/OutputBundle, as an output object."""
+    return output_path if isinstance(output_path, (OutputDirectory, OutputBundle)) else OutputDirectory(output_path)
+
+
+def write_csv(output_path, name, df: pd.DataFrame):
+    """Writes df as the CSV file `name` and returns its path."""
+    output = as_output(output_path)
+    with output.open(name) as f:
+        _to_text(df, f)
+    return output.path_of(name)
+
+
+def _to_text(df, binary_file):
+    text_file = io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+    df.to_csv(text_file, index=False)
+    text_file.detach()
+
+
+def _cell_rows(df: pd.DataFrame, header=True):
+    """The header and rows of df as plain Python values, with None for missing cells."""
+    columns = [
+        df.iloc[:, i].astype(object).where(df.iloc[:, i].notna(), None).tolist()
+        for i in range(df.shape[1])
+    ]
+    if header:
+        yield list(df.columns)
+    yield from zip(*columns)
+
+
+class ReportWriter(ABC):
+    """
+    Writes the sheets of one report. Use open_report() to create one.
+
+    Sheets are written with write(sheet_name, df), like DataFrame.to_excel; a second
+    block can go on the same sheet further down with startrow, as long as blocks are
+    written top to bottom. Use as a context manager, or call close().
+    """
+
+    def __init__(self, output, name):
+        self.output = output
+        self.path = output.path_of(name)
+        self.rows_written = {}
+        self.files = ExitStack()
+
+    def write(self, sheet_name, df: pd.DataFrame, startrow=0):
+        rows_written = self.rows_written.get(sheet_name, 0)
+        if startrow < rows_written:
+            raise ValueError(f"Sheet '{sheet_name}' already has {rows_written} rows; blocks must be written top to bottom.")
+        self._write(sheet_name, df, startrow, rows_written)
+        self.rows_written[sheet_name] = startrow + len(df) + 1
+
+    @abstractmethod
+    def _write(self, sheet_name, df, startrow, rows_written):
+        """Writes df at startrow of the sheet, which already has rows_written rows."""
+
+    def close(self):
+        self.files.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class XlsxReportWriter(ReportWriter):
+    """Streams rows straight into the workbook, so memory stays flat however large the sheets are."""
+
+    def __init__(self, output, name):
+        super().__init__(output, name)
+        self.sheets = {}
+        self.file = self.files.enter_context(output.open(name))
+        if xlsxwriter is not None:
+            # constant_memory streams through temporary files, which an in-memory workbook can't use
+            options = {'in_memory': True} if isinstance(output, OutputBundle) else {'constant_memory': True}
+            self.workbook = xlsxwriter.Workbook(self.file, {**options, 'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+        else:
+            from openpyxl import Workbook
+            self.workbook = Workbook(write_only=True)
+
+    def _write(self, sheet_name, df, startrow, rows_written):
+        if sheet_name not in self.sheets:
+            self.sheets[sheet_name] = self.workbook.add_worksheet(sheet_name) if xlsxwriter is not None \
+                else self.workbook.create_sheet(sheet_name)
+        sheet = self.sheets[sheet_name]
+        if xlsxwriter is not None:
+            for row_number, row in enumerate(_cell_rows(df), start=startrow):
+                sheet.write_row(row_number, 0, row)
+        else:
+            for _ in range(startrow - rows_written):
+                sheet.append([])
+            for row in _cell_rows(df):
+                sheet.append(row)
+
+    def close(self):
+        if xlsxwriter is not None:
+            self.workbook.close()
+        else:
+            self.workbook.save(self.file)
+        super().close()
+
+
+class CsvReportWriter(ReportWriter):
+    """Writes each sheet to <name>/<sheet>.csv. Further blocks are appended after blank lines."""
+
+    def __init__(self, output, name):
+        super().__init__(output, name)
+        self.sheet_files = {}
+
+    def _write(self, sheet_name, df, startrow, rows_written):
+        if sheet_name not in self.sheet_files:
+            binary_file = self.files.enter_context(self.output.open(f"{os.path.basename(self.path)}/{sheet_name}.csv"))
+            self.sheet_files[sheet_name] = binary_file
+        else:
+            binary_file = self.sheet_files[sheet_name]
+            binary_file.write(b'\n' * (startrow - rows_written))
+        _to_text(df, binary_file)
+
+
+class BundleReportWriter(ReportWriter):
+    """
+    Writes each sheet as a Parquet or Feather file inside one zip bundle. Needs pyarrow.
+
+    A sheet's further blocks become '<sheet> (2)', '<sheet> (3)', ...
+    """
+
+    def __init__(self, output, name, file_format):
+        super().__init__(output, name)
+        self.file_format = file_format
+        self.blocks = {}
+        self.bundle = zipfile.ZipFile(self.files.enter_context(output.open(name)), 'w', compression=zipfile.ZIP_STORED)
+
+    def _write(self, sheet_name, df, startrow, rows_written):
+        count = self.blocks.get(sheet_name, 0) + 1
+        self.blocks[sheet_name] = count
+        member = sheet_name if count == 1 else f"{sheet_name} ({count})"
+        buffer = io.BytesIO()
+        # Arrow needs string column names
+        df = df.reset_index(drop=True).rename(columns=str)
+        if self.file_format == 'parquet':
+            df.to_parquet(buffer, index=False)
+        else:
+            df.to_feather(buffer)
+        self.bundle.writestr(f"{member}.{self.file_format}", buffer.getvalue())
+
+    def close(self):
+        self.bundle.close()
+        super().close()
+
+
+def open_report(output_path, name, report_format='xlsx') -> ReportWriter:
+    """
+    Opens a report called `name` in output_path (a directory or an OutputBundle).
+
+    report_format is one of:
+        'xlsx': <name>.xlsx, streamed row by row
+        'csv': a <name> directory with one CSV per sheet
+        'parquet' / 'feather': <name>.<format>.zip with one file per sheet
+
+    The writer's path attribute is where the report ends up.
+    """
+    output = as_output(output_path)
+    if report_format == 'xlsx':
+        return XlsxReportWriter(output, f"{name}.xlsx")
+    if report_format == 'csv':
+        return CsvReportWriter(output, name)
+    if report_format in ('parquet', 'feather'):
+        return BundleReportWriter(output, f"{name}.{report_format}.zip", report_format)
+    raise ValueError(f"Unknown report format: '{report_format}'. Expected one of {REPORT_FORMATS}.")
@@ -0,0 +1,227 @@
+# tax_lots.py
+
+import numpy as np
+import pandas as pd
+
+# Store field -> closing position column for the per-lot numbers
+VALUE_COLUMNS = {
+    'amount': 'Amount',
+    'purchase_price': 'Purchase Price in USD',
+    'year_end_price': 'Year End Price in USD',
+    'cost_basis': 'Cost Basis in USD',
+    'year_end_value': 'Year End Value in USD',
+    'gain_loss': 'Gain/Loss in USD',
+}
+
+
+class _Categories:
+    """Labels of a categorical column, with the code of each label. New labels are added on demand."""
+
+    def __init__(self, values):
+        codes, labels = pd.factorize(pd.Series(values, dtype=object), use_na_sentinel=False)
+        self.codes = codes.astype(np.int64)
+        self.labels = list(labels)
+        self.lookup = {label: code for code, label in enumerate(self.labels)}
+
+    def code(self, label, add=False):
+        if label not in self.lookup:
+            if not add:
+                return -1
+            self.lookup[label] = len(self.labels)
+            self.labels.append(label)
+        return self.lookup[label]
+
+    def decode(self, codes):
+        return np.asarray(self.labels + [None], dtype=object)[codes]
+
+
+class TaxLotStore:
+    """
+    Tax lots held as parallel NumPy arrays instead of a wide DataFrame.
+
+    Amounts, prices, cost basis and year-end value/gain are float arrays; currency
+    and account are categorical codes. Lots split off another lot keep a reference
+    to the closing position row they came from, so the other columns are only
+    looked up again in to_frame(). Comments are an append-only log of (lot id, text)
+    events, with the latest text per lot kept alongside for lookups.
+
+    Lot ids are positions: the rows of the frame the store was built from come
+    first, new lots are appended in the order they are created. Arrays grow by
+    doubling, so adding lots one at a time stays linear.
+    """
+
+    def __init__(self, base_df: pd.DataFrame):
+        self.base_df = base_df
+        self.size = len(base_df)
+        self.currencies = _Categories(base_df['Currency'])
+        self.accounts = _Categories(base_df['Account'])
+        self._arrays = {
+            field: pd.to_numeric(base_df[col], errors='coerce').to_numpy(dtype=float, copy=True)
+            if col in base_df.columns else np.zeros(self.size)
+            for field, col in VALUE_COLUMNS.items()
+        }
+        self._arrays['currency'] = self.currencies.codes
+        self._arrays['account'] = self.accounts.codes
+        self._arrays['date'] = base_df['Date Acquired'].to_numpy(copy=True) if 'Date Acquired' in base_df.columns \
+            else np.full(self.size, np.datetime64('NaT', 'ns'))
+        self._arrays['source'] = np.arange(self.size, dtype=np.int64)
+        self._arrays['comments'] = base_df['comments'].to_numpy(dtype=object, copy=True) if 'comments' in base_df.columns \
+            else np.full(self.size, '', dtype=object)
+        # Other columns of lots added without a source row, by lot id
+        self.attributes = {}
+        self.events = []
+
+    @classmethod
+    def from_frame(cls, lots_df: pd.DataFrame) -> 'TaxLotStore':
+        """Builds a store over a closing position frame. The frame is kept as is and not modified."""
+        return cls(lots_df)
+
+    def __len__(self):
+        return self.size
+
+    def __getattr__(self, field):
+        # amount, cost_basis, date, ... are views of the live part of each array. Take them
+        # again after adding lots, since growing replaces the arrays.
+        arrays = self.__dict__.get('_arrays')
+        if arrays is None or field not in arrays:
+            raise AttributeError(field)
+        return arrays[field][:self.size]
+
+    def _append(self):
+        capacity = len(self._arrays['amount'])
+        if self.size == capacity:
+            for field, values in self._arrays.items():
+                grown = np.empty(max(2 * capacity, 16), dtype=values.dtype)
+                grown[:capacity] = values
+                self._arrays[field] = grown
+        lot = self.size
+        self.size += 1
+        return lot
+
+    def currency_of(self, lot):
+        return self.currencies.labels[self._arrays['currency'][lot]]
+
+    def account_of(self, lot):
+        return self.accounts.labels[self._arrays['account'][lot]]
+
+    def lots(self, currency, accounts=None, positive=True):
+        """Ids of the lots of `currency` (held in any of `accounts`), by default only those with a positive amount."""
+        mask = self.currency == self.currencies.code(currency)
+        if accounts is not None:
+            mask &= np.isin(self.account, [self.accounts.code(account) for account in accounts])
+        if positive:
+            mask &= self.amount > 0
+        return np.flatnonzero(mask)
+
+    def groups(self):
+        """Ids of every lot per (currency, account), in lot order."""
+        keys = pd.MultiIndex.from_arrays([self.currencies.decode(self.currency), self.accounts.decode(self.account)])
+        return pd.Series(np.arange(self.size)).groupby(keys, sort=False, dropna=False).indices
+
+    def add(self, row: dict):
+        """Adds a lot from a dict of closing position columns and returns its id."""
+        lot = self._append()
+        arrays = self._arrays
+        for field, col in VALUE_COLUMNS.items():
+            arrays[field][lot] = row.get(col, 0.0)
+        arrays['currency'][lot] = self.currencies.code(row.get('Currency'), add=True)
+        arrays['account'][lot] = self.accounts.code(row.get('Account'), add=True)
+        arrays['date'][lot] = row.get('Date Acquired', pd.NaT)
+        arrays['source'][lot] = -1
+        arrays['comments'][lot] = row.get('comments', '')
+        self.attributes[lot] = dict(row)
+        return lot
+
+    def split(self, lot, amount, cost_basis, year_end_value):
+        """
+        Moves `amount` of a lot, with the given cost basis and year-end value, into a new lot.
+
+        The new lot's gain is its year-end value less its cost basis, and the same
+        amounts come off the original lot. Returns the new lot's id.
+        """
+        new_lot = self._append()
+        arrays = self._arrays
+        for field in ('currency', 'account', 'date', 'source', 'comments', 'purchase_price', 'year_end_price'):
+            arrays[field][new_lot] = arrays[field][lot]
+        gain_loss = year_end_value - cost_basis
+        arrays['amount'][new_lot] = amount
+        arrays['cost_basis'][new_lot] = cost_basis
+        arrays['year_end_value'][new_lot] = year_end_value
+        arrays['gain_loss'][new_lot] = gain_loss
+        arrays['amount'][lot] -= amount
+        arrays['cost_basis'][lot] -= cost_basis
+        arrays['year_end_value'][lot] -= year_end_value
+        arrays['gain_loss'][lot] -= gain_loss
+        if arrays['source'][lot] < 0:
+            self.attributes[new_lot] = self.attributes[lot]
+        return new_lot
+
+    def transfer(self, lot, amount, account, cost_basis, year_end_value):
+        """Splits `amount` off a lot into a new lot held in `account`. Returns the new lot's id."""
+        new_lot = self.split(lot, amount, cost_basis, year_end_value)
+        self._arrays['account'][new_lot] = self.accounts.code(account, add=True)
+        return new_lot
+
+    def write_off(self, lots, amounts, cost_bases):
+        """Removes `amounts` with the given cost bases from `lots`, reducing year-end value and gain to match."""
+        year_end_prices = self.year_end_price[lots]
+        self.amount[lots] -= amounts
+        self.cost_basis[lots] -= cost_bases
+        self.year_end_value[lots] -= amounts * year_end_prices
+        self.gain_loss[lots] -= amounts * (year_end_prices - self.purchase_price[lots])
+
+    def close_exhausted(self, lots, tolerance=1e-8):
+        """
+        Zeroes the amount of lots left with `tolerance` or less, and any cost basis they still carry.
+
+        Returns:
+            Which of `lots` were exhausted, and the cost basis taken off each (0 if none).
+        """
+        lots = np.atleast_1d(lots)
+        exhausted = self.amount[lots] <= tolerance
+        self.amount[lots[exhausted]] = 0
+        leftover = np.where(exhausted & (self.cost_basis[lots] > tolerance), self.cost_basis[lots], 0.0)
+        cleared = lots[leftover > 0]
+        self.cost_basis[cleared] = 0
+        self.gain_loss[cleared] = 0
+        return exhausted, leftover
+
+    def comment(self, lots, texts):
+        """Logs a comment for each lot; the latest one is the lot's comment."""
+        for lot, text in zip(np.atleast_1d(lots).tolist(), [texts] if isinstance(texts, str) else texts):
+            self.events.append((lot, text))
+            self._arrays['comments'][lot] = text
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        The lots as a closing position frame, in lot order.
+
+        Lots from a closing position row copy that row's other columns. Added lots
+        have just the columns they were added with, so columns new to the frame
+        come last. The index is kept unless lots were added.
+        """
+        source = self.source
+        sourced = np.flatnonzero(source >= 0)
+        lots_df = self.base_df.iloc[source[sourced]].copy()
+        lots_df['Account'] = self.accounts.decode(self.account[sourced])
+        for field, col in VALUE_COLUMNS.items():
+            if col in lots_df.columns:
+                lots_df[col] = self._arrays[field][sourced]
+        lots_df['comments'] = self.comments[sourced]
+        if self.size == len(self.base_df) and len(sourced) == self.size:
+            return lots_df
+
+        added = np.flatnonzero(source < 0)
+        if len(added) == 0:
+            return lots_df.reset_index(drop=True)
+        rows = []
+        for lot in added.tolist():
+            row = dict(self.attributes[lot])
+            row['Account'] = self.account_of(lot)
+            for field, col in VALUE_COLUMNS.items():
+                row[col] = self._arrays[field][lot]
+            row['comments'] = self._arrays['comments'][lot]
+            rows.append(row)
+        lots_df = pd.concat([lots_df, pd.DataFrame(rows)], ignore_index=True)
+        order = np.argsort(np.concatenate([sourced, added]), kind='stable')
+        return lots_df.iloc[order].reset_index(drop=True)